@@ -0,0 +1,83 @@
+import struct
+import time
+
+# Layout of the status file written by t128-icmp-healthcheck.py
+STATUS_FILE = '/run/128technology/icmp-healthcheck.status'
+STATUS_MAGIC = b'T128ICMP'
+STATUS_VERSION = 1
+STATES = ('unknown', 'success', 'timeout')
+LOST = 0xffffffff
+HEADER = struct.Struct('<8sHHHHIB3xIIIII')
+BUCKET = struct.Struct('<IHH')
+SEQ_OFFSET = 16
+
+
+def read_seq(fd):
+  fd.seek(SEQ_OFFSET)
+  return fd.read(4)
+
+
+def read_consistent(fd, retries=10):
+  """Copy the file while no update is in progress (seqlock)."""
+  for _ in range(retries):
+    seq = read_seq(fd)
+    fd.seek(0)
+    data = fd.read()
+    if len(seq) == 4 and struct.unpack('<I', seq)[0] % 2 == 0 and \
+        read_seq(fd) == seq:
+      return data
+    # give the writer time to finish its update
+    time.sleep(0.01)
+  return None
+
+
+def parse_status(data):
+  (magic, version, max_destinations, ring_size, window_minutes, _, state,
+   _, last_success, restarted, interval, updated) = HEADER.unpack_from(data)
+  if magic != STATUS_MAGIC or version != STATUS_VERSION:
+    return None
+  destination = struct.Struct('<64sIIIIHH{}I'.format(ring_size))
+  offset = HEADER.size + BUCKET.size * window_minutes
+  destinations = {}
+  for _ in range(max_destinations):
+    values = destination.unpack_from(data, offset)
+    offset += destination.size
+    name = values[0].rstrip(b'\0').decode('utf-8')
+    if not name:
+      continue
+    sent, received, destination_last_success, _, position, count = values[1:7]
+    ring = values[7:]
+    samples = [ring[(position - count + i) % ring_size] for i in range(count)]
+    rtts = [rtt / 1000.0 for rtt in samples if rtt != LOST]
+    destinations[name] = {
+      'sent': sent,
+      'received': received,
+      'last_success': destination_last_success,
+      'loss': round(float(samples.count(LOST)) / count, 3) if count else 0.0,
+      'rtt_avg_ms': round(sum(rtts) / len(rtts), 3) if rtts else None,
+    }
+  return {
+    'state': STATES[state] if state < len(STATES) else 'unknown',
+    'last_success': last_success,
+    'restarted': restarted,
+    'interval': interval,
+    'updated': updated,
+    'destinations': destinations,
+  }
+
+
+def main():
+  try:
+    fd = open(STATUS_FILE, 'rb', 0)
+  except (IOError, OSError):
+    return {}
+  try:
+    data = read_consistent(fd)
+  finally:
+    fd.close()
+  if not data or len(data) < HEADER.size:
+    return {}
+  status = parse_status(data)
+  if not status:
+    return {}
+  return {'icmp_healthcheck': status}
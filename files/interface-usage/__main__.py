@@ -1,13 +1,19 @@
 #!/usr/bin/env python3
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+import csv
+from datetime import datetime
 import json
-import os
+import sys
 import time
 
 from lib.log import *
 from lib import log
 from lib.api import RestGraphqlApi
+from lib import history
+from lib.store import open_bucket_store
+from lib.usages import UsagesWriter
 
 
 def parse_arguments():
@@ -21,47 +27,49 @@ def parse_arguments():
     parser.add_argument('--meta-file',
                         default='/var/www/128technology/t128-interface-usage/t128-interface-usage-meta.json')
     parser.add_argument('--buckets-file',
-                        default='/var/lib/128technology/t128-interface-usage-buckets.json')
+                        default='/var/lib/128technology/t128-interface-usage-buckets.json',
+                        help='Buckets file (.json) or sqlite database')
+    parser.add_argument('--import-buckets',
+                        help='Import buckets from json file and exit')
+    parser.add_argument('--export-buckets',
+                        help='Export buckets to json file and exit')
     parser.add_argument('--usages-file',
                         default='/var/www/128technology/t128-interface-usage/t128-interface-usages.json')
+    parser.add_argument('--history-file',
+                        help='Record samples in a history database')
+    parser.add_argument('--history-retention',
+                        default=history.DEFAULT_RETENTION,
+                        help='Retention days per tier (0 = keep forever)')
+    parser.add_argument('--report', action='store_true',
+                        help='Print usages from the history database')
+    parser.add_argument('--from', dest='from_time',
+                        help='Report start (UTC): YYYY-MM-DD[THH:MM]')
+    parser.add_argument('--to', dest='to_time',
+                        help='Report end (UTC): YYYY-MM-DD[THH:MM]')
+    parser.add_argument('--tier', choices=history.TIERS, default='daily',
+                        help='Report aggregation tier')
+    parser.add_argument('--page-size', type=int, default=500,
+                        help='Number of nodes per usages page file '
+                             '(0 = single usages file)')
     parser.add_argument('--base-interfaces',
                         help='Populate interfaces list (also for ordering)')
     parser.add_argument('--blacklisted-interfaces',
                         default='ha_sync,ha_fabric')
     parser.add_argument('--blacklisted-routers', default='')
+    parser.add_argument('--batch-size', type=int, default=100,
+                        help='Number of interfaces per metrics query '
+                             '(1 = one query per interface)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of concurrent metrics queries')
     args = parser.parse_args()
     return args
 
 
-def read_buckets(filename):
-    try:
-        with open(filename) as fd:
-            return json.load(fd)
-    except FileNotFoundError:
-        return {}
-
-
 def write_meta(filename, meta):
     with open(filename, 'w') as fd:
         return json.dump(meta, fd)
 
 
-def write_buckets(filename, buckets):
-    with open(filename, 'w') as fd:
-        return json.dump(buckets, fd)
-
-
-def write_usages(filename, first_ts, interfaces, usages):
-    with open(filename, 'w') as fd:
-        os.chmod(filename, 0o444)
-        return json.dump({
-            'created': int(time.time()),
-            'first_ts': first_ts,
-            'interfaces': interfaces,
-            'usages': usages,
-        }, fd)
-
-
 def get_meta_data(filename, api):
     fields = ['description', 'location']
     meta = {}
@@ -70,27 +78,14 @@ def get_meta_data(filename, api):
     write_meta(filename, meta)
 
 
-def main():
-    args = parse_arguments()
-    log.DEBUG = args.debug
-    log.LOGFILE = args.log_file
-    blacklisted_interfaces = args.blacklisted_interfaces.split(',')
-    blacklisted_routers = args.blacklisted_routers.split(',')
-    api = RestGraphqlApi(args.host)
-
-    # run script in meta file generator mode
-    if args.generate_meta_file:
-        get_meta_data(args.meta_file, api)
-        return
-
-    # Iterate over all routers and retrieve interface usage stats
-    interfaces = []
-    if args.base_interfaces:
-        interfaces = args.base_interfaces.split(',')
-    buckets = read_buckets(args.buckets_file)
-    usages = []
+def get_router_nodes(api, interfaces, blacklisted_routers,
+                     blacklisted_interfaces):
+    """Return a list of (router, node, [interfaces]) to be collected.
 
-    first_ts = int(time.time())
+    Interface names which are seen for the first time are appended to
+    the interfaces list (used for the columns of the web application).
+    """
+    router_nodes = []
     for r in api.get_interfaces()['data']['allRouters']['nodes']:
         router = r['name']
         if router in blacklisted_routers:
@@ -98,70 +93,157 @@ def main():
 
         for n in r['nodes']['nodes']:
             node = n['name']
-            node_usage = {}
-            # print(node)
+            node_interfaces = []
             for i in n['deviceInterfaces']['nodes']:
                 # ignore host interfaces
                 if i['type'] == 'host':
                     continue
-                    # ignore blacklisted interfaces
+                # ignore blacklisted interfaces
                 interface = i['name']
-                # print(interface)
                 if interface in blacklisted_interfaces:
                     continue
                 if interface not in interfaces:
                     interfaces.append(interface)
+                node_interfaces.append(interface)
+            router_nodes.append((router, node, node_interfaces))
+    return router_nodes
+
+
+def get_interface_stats(api, keys, batch_size, workers=1):
+    """Retrieve stats for all (router, node, interface) keys.
+
+    When batch_size is larger than one, the interfaces are queried in
+    batches of aliased metrics queries instead of one query each.
+    Batches are fetched by a pool of worker threads, which share the
+    api session and token. Results are merged in order of the keys.
+    """
+    batch_size = max(batch_size, 1)
+    batches = [keys[start:start + batch_size]
+               for start in range(0, len(keys), batch_size)]
+
+    def fetch(batch):
+        debug('Query interface usages for {} interfaces'.format(len(batch)))
+        if len(batch) == 1:
+            return [api.get_interface_usage(*batch[0])]
+        return api.get_interface_usages(batch)
+
+    stats = {}
+    if workers <= 1:
+        results = map(fetch, batches)
+    else:
+        # login before the workers start - they re-use the token
+        api.ensure_login()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(fetch, batches))
+    for batch, batch_stats in zip(batches, results):
+        stats.update(zip(batch, batch_stats))
+    return stats
+
+
+def migrate_buckets(store, import_file=None, export_file=None):
+    """Import/export buckets of a store from/to a json file."""
+    if import_file:
+        with open(import_file) as fd:
+            store.import_buckets(json.load(fd))
+        info('Imported buckets from', import_file)
+    if export_file:
+        with open(export_file, 'w') as fd:
+            json.dump(store.export_buckets(), fd)
+        info('Exported buckets to', export_file)
+
+
+def print_report(history_store, tier, from_time, to_time):
+    """Print aggregated usages of a time range as csv."""
+    start = 0
+    end = int(time.time())
+    try:
+        if from_time:
+            start = history.parse_time(from_time)
+        if to_time:
+            end = history.parse_time(to_time)
+    except ValueError as e:
+        fatal(str(e))
+    writer = csv.writer(sys.stdout)
+    writer.writerow(
+        ('period', 'router', 'node', 'interface', 'received', 'sent'))
+    for row in history_store.report(tier, start, end):
+        period = '{:%Y-%m-%d %H:%M}'.format(datetime.utcfromtimestamp(row[0]))
+        writer.writerow((period,) + tuple(row[1:]))
 
-                # get stats and update buckets/data usage
-                current_stats = api.get_interface_usage(router, node, interface)
-                if not current_stats:
-                    # no data could be retrieved
-                    continue
 
-                # prepare new bucket
-                ts, received, sent = current_stats
-                this_bucket = [current_stats, current_stats]
-
-                last_bucket = []
-                try:
-                    if buckets[router][node][interface]:
-                        # get first bucket's ts for this interface
-                        ts = buckets[router][node][interface][0][0][0]
-                        last_bucket = buckets[router][node][interface].pop()
-                        if ts < first_ts:
-                            first_ts = ts
-                except (KeyError, IndexError):
-                    pass
-
-                # keep the first and last bucket on integer overflow (128T restart)
-                if last_bucket:
-                    if received < last_bucket[1][1] or sent < last_bucket[1][2]:
-                        buckets[router][node][interface].append(last_bucket)
-                    else:
-                        this_bucket[0] = last_bucket[0]
-
-                # init
-                if router not in buckets:
-                        buckets[router] = {}
-                if node not in buckets[router]:
-                        buckets[router][node] = {}
-                if interface not in buckets[router][node]:
-                        buckets[router][node][interface] = []
-                buckets[router][node][interface].append(this_bucket)
-
-                # calculate data usage
-                sum_received = 0
-                sum_sent = 0
-                # sum all buckets
-                for bucket in buckets[router][node][interface]:
-                    sum_received = bucket[1][1] - bucket[0][1]
-                    sum_sent = bucket[1][2] - bucket[0][2]
-
-                node_usage[interface] = sum_received + sum_sent
-            usages.append((router, node, node_usage))
-
-    write_buckets(args.buckets_file, buckets)
-    write_usages(args.usages_file, first_ts, interfaces, usages)
+def main():
+    args = parse_arguments()
+    log.DEBUG = args.debug
+    log.LOGFILE = args.log_file
+    blacklisted_interfaces = args.blacklisted_interfaces.split(',')
+    blacklisted_routers = args.blacklisted_routers.split(',')
+    api = RestGraphqlApi(args.host, pool_size=max(args.workers, 10))
+
+    # run script in meta file generator mode
+    if args.generate_meta_file:
+        get_meta_data(args.meta_file, api)
+        return
+
+    # run script in report mode
+    if args.report:
+        if not args.history_file:
+            fatal('--report requires --history-file')
+        history_store = history.HistoryStore(args.history_file)
+        print_report(history_store, args.tier, args.from_time, args.to_time)
+        history_store.close()
+        return
+
+    # run script in migration mode
+    if args.import_buckets or args.export_buckets:
+        store = open_bucket_store(args.buckets_file)
+        migrate_buckets(store, args.import_buckets, args.export_buckets)
+        store.close()
+        return
+
+    # Iterate over all routers and collect the interfaces to be queried
+    interfaces = []
+    if args.base_interfaces:
+        interfaces = args.base_interfaces.split(',')
+    router_nodes = get_router_nodes(
+        api, interfaces, blacklisted_routers, blacklisted_interfaces)
+
+    # retrieve interface usage stats for all interfaces
+    first_ts = int(time.time())
+    keys = [(router, node, interface)
+            for router, node, node_interfaces in router_nodes
+            for interface in node_interfaces]
+    stats = get_interface_stats(api, keys, args.batch_size, args.workers)
+
+    store = open_bucket_store(args.buckets_file)
+    history_store = None
+    if args.history_file:
+        history_store = history.HistoryStore(
+            args.history_file, args.history_retention)
+    usages = UsagesWriter(args.usages_file, args.page_size)
+    for router, node, node_interfaces in router_nodes:
+        node_usage = {}
+        for interface in node_interfaces:
+            current_stats = stats.get((router, node, interface))
+            if not current_stats:
+                # no data could be retrieved
+                continue
+
+            ts = store.update(router, node, interface, current_stats)
+            if history_store:
+                history_store.record(router, node, interface, current_stats)
+            if ts < first_ts:
+                first_ts = ts
+
+            # calculate data usage from running totals
+            sum_received, sum_sent = store.get_usage(router, node, interface)
+            node_usage[interface] = sum_received + sum_sent
+        usages.add(router, node, node_usage)
+
+    store.close()
+    if history_store:
+        history_store.prune()
+        history_store.close()
+    usages.close(first_ts, interfaces)
 
 
 if __name__ == '__main__':
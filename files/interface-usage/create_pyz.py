@@ -8,6 +8,8 @@ project_name = project_dir.split('/')[-1]
 archive_name = 't128-' + project_name + '.pyz'
 
 def filter_archive(file):
+    if file.parts[0] == 'tests':
+        return False
     if file.suffix == '.py' or file.name == 'lib':
         return True
     else:
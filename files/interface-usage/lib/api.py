@@ -1,5 +1,6 @@
 import os
 import requests
+import threading
 import time
 
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
@@ -28,10 +29,20 @@ class RestGraphqlApi(object):
     token = None
     authorized = False
 
-    def __init__(self, host='localhost', verify=False):
+    def __init__(self, host='localhost', verify=False, pool_size=10):
         self.host = host
         self.verify = verify
         self.session = requests.Session()
+        # allow concurrent threads to share the session's connections
+        self.session.mount('https://', requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size))
+        self.login_lock = threading.Lock()
+
+    def ensure_login(self):
+        """Login once - even when called from concurrent threads."""
+        with self.login_lock:
+            if not self.authorized:
+                self.login()
 
     def get(self, location, authorization_required=True):
         """Get data per REST API."""
@@ -41,7 +52,7 @@ class RestGraphqlApi(object):
         }
         if authorization_required:
             if not self.authorized:
-                self.login()
+                self.ensure_login()
             if self.token:
                 headers['Authorization'] = 'Bearer {}'.format(self.token)
         request = self.session.get(
@@ -58,7 +69,7 @@ class RestGraphqlApi(object):
         # Login if not yet done
         if authorization_required:
             if not self.authorized:
-                self.login()
+                self.ensure_login()
             if self.token:
                 headers['Authorization'] = 'Bearer {}'.format(self.token)
         request = self.session.post(
@@ -75,7 +86,7 @@ class RestGraphqlApi(object):
         # Login if not yet done
         if authorization_required:
             if not self.authorized:
-                self.login()
+                self.ensure_login()
             if self.token:
                 headers['Authorization'] = 'Bearer {}'.format(self.token)
         request = self.session.patch(
@@ -95,7 +106,7 @@ class RestGraphqlApi(object):
         # Login if not yet done
         if authorization_required:
             if not self.authorized:
-                self.login()
+                self.ensure_login()
             if self.token:
                 headers['Authorization'] = 'Bearer {}'.format(self.token)
 
@@ -180,3 +191,40 @@ class RestGraphqlApi(object):
         except (TypeError, IndexError):
              return None
         return (int(time.time()), received, sent)
+
+    def get_interface_usages(self, interfaces):
+        """Retrieve interface usages for many interfaces with one query.
+
+        interfaces is a list of (router, node, interface) tuples. Each of
+        them gets an alias inside the metrics query. The result is a list
+        of (ts, received, sent) tuples - or None if no data could be
+        retrieved - in the same order as the given interfaces.
+        """
+        fields = []
+        for i, (router, node, interface) in enumerate(interfaces):
+            fields.append(
+                'i%d: bytes(router: "%s", node: "%s", port: "%s") '
+                '{ timeseries(startTime: "now-10") { timestamp value } }' % (
+                    i, router, node, interface))
+        fields = ' '.join(fields)
+        query = '{ metrics { interface { received { %s } sent { %s } } } }' % (
+            fields, fields)
+        ts = int(time.time())
+        try:
+            metrics = self.query(query).json()['data']['metrics']['interface']
+            received_metrics = metrics['received']
+            sent_metrics = metrics['sent']
+        except (ValueError, KeyError, TypeError):
+            return [None] * len(interfaces)
+
+        usages = []
+        for i in range(len(interfaces)):
+            alias = 'i{}'.format(i)
+            try:
+                received = int(extract(received_metrics[alias], 'value'))
+                sent = int(extract(sent_metrics[alias], 'value'))
+            except (KeyError, TypeError, IndexError):
+                usages.append(None)
+                continue
+            usages.append((ts, received, sent))
+        return usages
@@ -0,0 +1,175 @@
+import calendar
+from datetime import datetime
+import sqlite3
+import time
+
+TIERS = ('hourly', 'daily', 'monthly')
+DEFAULT_RETENTION = 'raw:2,hourly:31,daily:400,monthly:0'
+
+
+def parse_retention(retention):
+    """Parse 'tier:days,...' into a dict - 0 days means keep forever."""
+    days = {}
+    for item in retention.split(','):
+        tier, value = item.split(':')
+        days[tier.strip()] = int(value)
+    return days
+
+
+def parse_time(value):
+    """Convert a UTC date (and time) string to a unix timestamp."""
+    for fmt in ('%Y-%m-%d', '%Y-%m-%dT%H:%M', '%Y-%m-%d %H:%M'):
+        try:
+            return calendar.timegm(time.strptime(value, fmt))
+        except ValueError:
+            pass
+    raise ValueError('Invalid time format: {}'.format(value))
+
+
+def period_start(tier, ts):
+    """Return the start of the tier's period which contains ts."""
+    if tier == 'hourly':
+        return ts - ts % 3600
+    if tier == 'daily':
+        return ts - ts % 86400
+    if tier == 'monthly':
+        dt = datetime.utcfromtimestamp(ts)
+        return calendar.timegm((dt.year, dt.month, 1, 0, 0, 0))
+    raise ValueError('Unknown tier: {}'.format(tier))
+
+
+def next_period(tier, period):
+    """Return the start of the tier's period which follows period."""
+    if tier == 'monthly':
+        dt = datetime.utcfromtimestamp(period)
+        year, month = (dt.year + 1, 1) if dt.month == 12 else (dt.year, dt.month + 1)
+        return calendar.timegm((year, month, 1, 0, 0, 0))
+    return period_start(tier, period) + (3600 if tier == 'hourly' else 86400)
+
+
+def split_delta(tier, start, end, delta):
+    """Split delta bytes of start..end by time into the tier's periods.
+
+    Return a list of (period, bytes) - the parts always sum up to delta.
+    """
+    period = period_start(tier, start)
+    if end <= start:
+        return [(period_start(tier, end), delta)]
+    parts = []
+    done = 0
+    while period < end:
+        following = next_period(tier, period)
+        # round on the cumulative time so no byte is lost
+        value = delta * (min(following, end) - start) // (end - start) - done
+        parts.append((period, value))
+        done += value
+        period = following
+    return parts
+
+
+class HistoryStore(object):
+    """Time-series history of interface usages in a sqlite database.
+
+    Every sample is recorded as raw sample. The bytes since the previous
+    sample of an interface (the counter value itself after a counter
+    reset) are added to the hourly, daily and monthly aggregates - split
+    by time when the samples are in different periods - so range reports
+    never have to scan the raw samples.
+    """
+
+    schema = '''
+        CREATE TABLE IF NOT EXISTS samples (
+            router TEXT NOT NULL,
+            node TEXT NOT NULL,
+            interface TEXT NOT NULL,
+            ts INTEGER NOT NULL,
+            received INTEGER,
+            sent INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS samples_ts ON samples (ts);
+        CREATE TABLE IF NOT EXISTS last_samples (
+            router TEXT NOT NULL,
+            node TEXT NOT NULL,
+            interface TEXT NOT NULL,
+            ts INTEGER,
+            received INTEGER,
+            sent INTEGER,
+            PRIMARY KEY (router, node, interface)
+        );
+        CREATE TABLE IF NOT EXISTS usages (
+            tier TEXT NOT NULL,
+            period INTEGER NOT NULL,
+            router TEXT NOT NULL,
+            node TEXT NOT NULL,
+            interface TEXT NOT NULL,
+            received INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (tier, period, router, node, interface)
+        );
+    '''
+
+    def __init__(self, filename, retention=DEFAULT_RETENTION):
+        self.db = sqlite3.connect(filename)
+        self.db.executescript(self.schema)
+        self.retention = parse_retention(retention)
+
+    def record(self, router, node, interface, current_stats):
+        """Record a sample and add its bytes to the aggregates."""
+        key = (router, node, interface)
+        ts, received, sent = current_stats
+        self.db.execute('INSERT INTO samples VALUES (?, ?, ?, ?, ?, ?)',
+                        key + (ts, received, sent))
+        last = self.db.execute(
+            'SELECT ts, received, sent FROM last_samples '
+            'WHERE router = ? AND node = ? AND interface = ?', key).fetchone()
+        self.db.execute(
+            'INSERT OR REPLACE INTO last_samples VALUES (?, ?, ?, ?, ?, ?)',
+            key + (ts, received, sent))
+        if not last:
+            # first sample - nothing to aggregate yet
+            return
+
+        # counter reset (128T restart): count from zero
+        last_ts, last_received, last_sent = last
+        delta_received = received - last_received if received >= last_received else received
+        delta_sent = sent - last_sent if sent >= last_sent else sent
+        for tier in TIERS:
+            parts = zip(split_delta(tier, last_ts, ts, delta_received),
+                        split_delta(tier, last_ts, ts, delta_sent))
+            for (period, part_received), (_, part_sent) in parts:
+                self.db.execute(
+                    'INSERT OR IGNORE INTO usages '
+                    '(tier, period, router, node, interface) '
+                    'VALUES (?, ?, ?, ?, ?)', (tier, period) + key)
+                self.db.execute(
+                    'UPDATE usages SET received = received + ?, sent = sent + ? '
+                    'WHERE tier = ? AND period = ? AND router = ? AND node = ? '
+                    'AND interface = ?',
+                    (part_received, part_sent, tier, period) + key)
+
+    def prune(self, now=None):
+        """Remove samples and aggregates older than their retention."""
+        if not now:
+            now = int(time.time())
+        days = self.retention.get('raw', 0)
+        if days:
+            self.db.execute('DELETE FROM samples WHERE ts < ?',
+                            (now - days * 86400,))
+        for tier in TIERS:
+            days = self.retention.get(tier, 0)
+            if days:
+                self.db.execute(
+                    'DELETE FROM usages WHERE tier = ? AND period < ?',
+                    (tier, period_start(tier, now - days * 86400)))
+
+    def report(self, tier, start, end):
+        """Return aggregated usages of a tier with start <= period < end."""
+        return self.db.execute(
+            'SELECT period, router, node, interface, received, sent '
+            'FROM usages WHERE tier = ? AND period >= ? AND period < ? '
+            'ORDER BY period, router, node, interface',
+            (tier, period_start(tier, start), end)).fetchall()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
@@ -0,0 +1,290 @@
+import json
+import sqlite3
+
+
+def open_bucket_store(filename):
+    """Return a bucket store based on the file extension."""
+    if filename.endswith('.json'):
+        return JsonBucketStore(filename)
+    return SqliteBucketStore(filename)
+
+
+class JsonBucketStore(object):
+    """Buckets kept as one nested json file.
+
+    The file is structured as router -> node -> interface -> buckets,
+    where each bucket is a pair of [ts, received, sent] samples. It is
+    read completely on start and re-written on close. Running totals of
+    the closed buckets are calculated once after reading the file.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        try:
+            with open(filename) as fd:
+                self.import_buckets(json.load(fd))
+        except FileNotFoundError:
+            self.import_buckets({})
+
+    def update(self, router, node, interface, current_stats):
+        """Add current stats to the buckets of an interface.
+
+        Returns the timestamp of the first bucket for this interface.
+        """
+        buckets = self.buckets
+        # prepare new bucket
+        ts, received, sent = current_stats
+        this_bucket = [current_stats, current_stats]
+
+        last_bucket = []
+        try:
+            if buckets[router][node][interface]:
+                # get first bucket's ts for this interface
+                ts = buckets[router][node][interface][0][0][0]
+                last_bucket = buckets[router][node][interface].pop()
+        except (KeyError, IndexError):
+            pass
+
+        # keep the first and last bucket on integer overflow (128T restart)
+        if last_bucket:
+            if received < last_bucket[1][1] or sent < last_bucket[1][2]:
+                buckets[router][node][interface].append(last_bucket)
+                self._add_total((router, node, interface), last_bucket)
+            else:
+                this_bucket[0] = last_bucket[0]
+
+        # init
+        if router not in buckets:
+                buckets[router] = {}
+        if node not in buckets[router]:
+                buckets[router][node] = {}
+        if interface not in buckets[router][node]:
+                buckets[router][node][interface] = []
+        buckets[router][node][interface].append(this_bucket)
+        return ts
+
+    def _add_total(self, key, bucket):
+        """Add usage of a closed bucket to the running totals."""
+        total = self.totals.setdefault(key, [0, 0])
+        total[0] += bucket[1][1] - bucket[0][1]
+        total[1] += bucket[1][2] - bucket[0][2]
+
+    def get_buckets(self, router, node, interface):
+        """Return all buckets of an interface."""
+        try:
+            return self.buckets[router][node][interface]
+        except KeyError:
+            return []
+
+    def get_usage(self, router, node, interface):
+        """Return (received, sent) bytes summed over all buckets."""
+        received, sent = self.totals.get((router, node, interface), (0, 0))
+        try:
+            first, last = self.buckets[router][node][interface][-1]
+            received += last[1] - first[1]
+            sent += last[2] - first[2]
+        except (KeyError, IndexError):
+            pass
+        return received, sent
+
+    def import_buckets(self, buckets):
+        """Replace all buckets by the given nested dict."""
+        self.buckets = buckets
+        self.totals = {}
+        for router, nodes in buckets.items():
+            for node, interfaces in nodes.items():
+                for interface, interface_buckets in interfaces.items():
+                    for bucket in interface_buckets[:-1]:
+                        self._add_total((router, node, interface), bucket)
+
+    def export_buckets(self):
+        """Return all buckets as nested dict."""
+        return self.buckets
+
+    def close(self):
+        with open(self.filename, 'w') as fd:
+            json.dump(self.buckets, fd)
+
+
+class SqliteBucketStore(object):
+    """Buckets kept in a sqlite database.
+
+    Closed buckets (after a counter reset) are appended to the buckets
+    table and never touched again. The open_buckets table is an index
+    holding the current bucket per interface and the running totals of
+    all closed buckets - this is the only row which is updated on each
+    run.
+    """
+
+    schema = '''
+        CREATE TABLE IF NOT EXISTS buckets (
+            id INTEGER PRIMARY KEY,
+            router TEXT NOT NULL,
+            node TEXT NOT NULL,
+            interface TEXT NOT NULL,
+            first_ts INTEGER, first_received INTEGER, first_sent INTEGER,
+            last_ts INTEGER, last_received INTEGER, last_sent INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS buckets_interface
+            ON buckets (router, node, interface);
+        CREATE TABLE IF NOT EXISTS open_buckets (
+            router TEXT NOT NULL,
+            node TEXT NOT NULL,
+            interface TEXT NOT NULL,
+            ts INTEGER,
+            first_ts INTEGER, first_received INTEGER, first_sent INTEGER,
+            last_ts INTEGER, last_received INTEGER, last_sent INTEGER,
+            closed_received INTEGER NOT NULL DEFAULT 0,
+            closed_sent INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (router, node, interface)
+        );
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        self.db.executescript(self.schema)
+        self._migrate_totals()
+
+    def _migrate_totals(self):
+        """Add running totals to databases created without them."""
+        columns = [row[1] for row in self.db.execute(
+            'PRAGMA table_info(open_buckets)')]
+        if 'closed_received' in columns:
+            return
+        self.db.executescript('''
+            ALTER TABLE open_buckets
+                ADD COLUMN closed_received INTEGER NOT NULL DEFAULT 0;
+            ALTER TABLE open_buckets
+                ADD COLUMN closed_sent INTEGER NOT NULL DEFAULT 0;
+        ''')
+        self._update_totals()
+
+    def _update_totals(self):
+        """Calculate running totals from all closed buckets."""
+        self.db.execute('''
+            UPDATE open_buckets SET
+                closed_received = (
+                    SELECT COALESCE(SUM(last_received - first_received), 0)
+                    FROM buckets b WHERE b.router = open_buckets.router
+                    AND b.node = open_buckets.node
+                    AND b.interface = open_buckets.interface),
+                closed_sent = (
+                    SELECT COALESCE(SUM(last_sent - first_sent), 0)
+                    FROM buckets b WHERE b.router = open_buckets.router
+                    AND b.node = open_buckets.node
+                    AND b.interface = open_buckets.interface)
+        ''')
+
+    def update(self, router, node, interface, current_stats):
+        """Add current stats to the buckets of an interface.
+
+        Returns the timestamp of the first bucket for this interface.
+        """
+        key = (router, node, interface)
+        ts, received, sent = current_stats
+        row = self.db.execute(
+            'SELECT ts, first_ts, first_received, first_sent, '
+            'last_ts, last_received, last_sent FROM open_buckets '
+            'WHERE router = ? AND node = ? AND interface = ?', key).fetchone()
+        if not row:
+            self.db.execute(
+                'INSERT INTO open_buckets (router, node, interface, ts, '
+                'first_ts, first_received, first_sent, '
+                'last_ts, last_received, last_sent) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                key + (ts,) + tuple(current_stats) + tuple(current_stats))
+            return ts
+
+        first_ts = row[0]
+        last_received, last_sent = row[5], row[6]
+        if received < last_received or sent < last_sent:
+            # counter reset (128T restart) - close the open bucket
+            self.db.execute(
+                'INSERT INTO buckets (router, node, interface, '
+                'first_ts, first_received, first_sent, '
+                'last_ts, last_received, last_sent) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', key + row[1:])
+            self.db.execute(
+                'UPDATE open_buckets SET '
+                'closed_received = closed_received + ?, '
+                'closed_sent = closed_sent + ?, '
+                'first_ts = ?, first_received = ?, first_sent = ?, '
+                'last_ts = ?, last_received = ?, last_sent = ? '
+                'WHERE router = ? AND node = ? AND interface = ?',
+                (last_received - row[2], last_sent - row[3]) +
+                tuple(current_stats) + tuple(current_stats) + key)
+        else:
+            self.db.execute(
+                'UPDATE open_buckets SET '
+                'last_ts = ?, last_received = ?, last_sent = ? '
+                'WHERE router = ? AND node = ? AND interface = ?',
+                tuple(current_stats) + key)
+        return first_ts
+
+    def get_buckets(self, router, node, interface):
+        """Return all buckets of an interface."""
+        key = (router, node, interface)
+        rows = self.db.execute(
+            'SELECT first_ts, first_received, first_sent, '
+            'last_ts, last_received, last_sent FROM buckets '
+            'WHERE router = ? AND node = ? AND interface = ? '
+            'ORDER BY id', key).fetchall()
+        rows.extend(self.db.execute(
+            'SELECT first_ts, first_received, first_sent, '
+            'last_ts, last_received, last_sent FROM open_buckets '
+            'WHERE router = ? AND node = ? AND interface = ?', key).fetchall())
+        return [[list(row[:3]), list(row[3:])] for row in rows]
+
+    def get_usage(self, router, node, interface):
+        """Return (received, sent) bytes summed over all buckets."""
+        row = self.db.execute(
+            'SELECT closed_received + last_received - first_received, '
+            'closed_sent + last_sent - first_sent FROM open_buckets '
+            'WHERE router = ? AND node = ? AND interface = ?',
+            (router, node, interface)).fetchone()
+        if not row:
+            return 0, 0
+        return row
+
+    def import_buckets(self, buckets):
+        """Replace all buckets by the given nested dict."""
+        self.db.execute('DELETE FROM buckets')
+        self.db.execute('DELETE FROM open_buckets')
+        for router, nodes in buckets.items():
+            for node, interfaces in nodes.items():
+                for interface, interface_buckets in interfaces.items():
+                    if not interface_buckets:
+                        continue
+                    key = (router, node, interface)
+                    for first, last in interface_buckets[:-1]:
+                        self.db.execute(
+                            'INSERT INTO buckets (router, node, interface, '
+                            'first_ts, first_received, first_sent, '
+                            'last_ts, last_received, last_sent) '
+                            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                            key + tuple(first) + tuple(last))
+                    first, last = interface_buckets[-1]
+                    ts = interface_buckets[0][0][0]
+                    self.db.execute(
+                        'INSERT INTO open_buckets (router, node, interface, '
+                        'ts, first_ts, first_received, first_sent, '
+                        'last_ts, last_received, last_sent) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        key + (ts,) + tuple(first) + tuple(last))
+        self._update_totals()
+
+    def export_buckets(self):
+        """Return all buckets as nested dict."""
+        buckets = {}
+        keys = self.db.execute(
+            'SELECT router, node, interface FROM open_buckets '
+            'ORDER BY router, node, interface').fetchall()
+        for router, node, interface in keys:
+            buckets.setdefault(router, {}).setdefault(node, {})[interface] = \
+                self.get_buckets(router, node, interface)
+        return buckets
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
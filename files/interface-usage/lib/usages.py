@@ -0,0 +1,89 @@
+import glob
+import json
+import os
+import tempfile
+import time
+
+
+def write_json(filename, data, mode=0o444):
+    """Write json data to a temp file and rename it to filename.
+
+    Readers (e.g. the web application) never see a partially written file.
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp_name = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as tmp:
+            json.dump(data, tmp)
+        os.chmod(tmp_name, mode)
+        os.rename(tmp_name, filename)
+    except:
+        os.unlink(tmp_name)
+        raise
+
+
+class UsagesWriter(object):
+    """Write node usages as paginated json files.
+
+    Rows of (router, node, usage) are written to page files with up to
+    page_size rows as soon as a page is full. On close an index file
+    (the usages file) is written, which lists the pages with the
+    routers/nodes they contain. This allows the web application to fetch
+    only the pages needed for its current view.
+
+    A page_size of 0 writes all usages into the usages file itself.
+    """
+
+    def __init__(self, filename, page_size=0):
+        self.filename = filename
+        self.page_size = page_size
+        self.base_name = filename.rsplit('.json', 1)[0]
+        self.pages = []
+        self.rows = []
+
+    def page_name(self, number):
+        return '{}-{:04d}.json'.format(self.base_name, number)
+
+    def add(self, router, node, node_usage):
+        """Add usage of a node - flush a page if full."""
+        self.rows.append((router, node, node_usage))
+        if self.page_size and len(self.rows) >= self.page_size:
+            self.flush()
+
+    def flush(self):
+        """Write buffered rows to the next page file."""
+        if not self.rows:
+            return
+        page_name = self.page_name(len(self.pages) + 1)
+        write_json(page_name, {'usages': self.rows})
+        routers = {}
+        for router, node, _ in self.rows:
+            routers.setdefault(router, []).append(node)
+        self.pages.append({
+            'file': os.path.basename(page_name),
+            'count': len(self.rows),
+            'routers': routers,
+        })
+        self.rows = []
+
+    def remove_stale_pages(self):
+        """Remove pages of previous runs which are no longer listed."""
+        current_pages = [self.page_name(i + 1) for i in range(len(self.pages))]
+        for page_name in glob.glob('{}-[0-9]*.json'.format(self.base_name)):
+            if page_name not in current_pages:
+                os.unlink(page_name)
+
+    def close(self, first_ts, interfaces):
+        """Write the last page and the index file."""
+        index = {
+            'created': int(time.time()),
+            'first_ts': first_ts,
+            'interfaces': interfaces,
+        }
+        if self.page_size:
+            self.flush()
+            index['pages'] = self.pages
+        else:
+            index['usages'] = self.rows
+        write_json(self.filename, index)
+        self.remove_stale_pages()
@@ -2,7 +2,8 @@
 
 dir="/var/lib/128technology"
 # remove bucket files older than 90 days
-find "$dir" -maxdepth 1 -name t128-interface-usage-buckets*.json -ctime +90 -delete
+find "$dir" -maxdepth 1 -name 't128-interface-usage-buckets*.json' -ctime +90 -delete
+find "$dir" -maxdepth 1 -name 't128-interface-usage-buckets*.db' -ctime +90 -delete
 
 script=/srv/salt/files/t128-interface-usage.pyz
 
@@ -10,7 +11,14 @@ script=/srv/salt/files/t128-interface-usage.pyz
 $script --generate-meta-file
 
 # start new statistics capture - ensure buckets are reset every month
-options="--buckets-file $dir/t128-interface-usage-buckets-$(date '+%Y%m').json"
+buckets="$dir/t128-interface-usage-buckets-$(date '+%Y%m')"
+# migrate buckets of the current month written by earlier (json) versions
+if [ -f "$buckets.json" ] && [ ! -f "$buckets.db" ]; then
+    $script --buckets-file "$buckets.db" --import-buckets "$buckets.json"
+fi
+options="--buckets-file $buckets.db"
+# keep a history of samples with hourly/daily/monthly aggregates
+options="$options --history-file $dir/t128-interface-usage-history.db"
 # optionally, ignore interfaces and/or routers
 #options="$options --blacklisted-routers my-conductor"
 #options="$options --blacklisted-interfaces ha_sync,ha_fabric"
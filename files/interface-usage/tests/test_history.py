@@ -0,0 +1,75 @@
+import calendar
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.history import HistoryStore, split_delta
+
+KEY = ('router1', 'node1', 'wan1')
+# 2021-10-31 23:30 UTC
+TS = calendar.timegm((2021, 10, 31, 23, 30, 0))
+HOUR = TS - TS % 3600
+DAY = TS - TS % 86400
+OCTOBER = calendar.timegm((2021, 10, 1, 0, 0, 0))
+NOVEMBER = calendar.timegm((2021, 11, 1, 0, 0, 0))
+
+
+class SplitDeltaTests(unittest.TestCase):
+
+    def test_same_period(self):
+        self.assertEqual(split_delta('hourly', TS, TS + 600, 100),
+                         [(HOUR, 100)])
+
+    def test_across_periods(self):
+        self.assertEqual(split_delta('hourly', TS, TS + 3600, 100),
+                         [(HOUR, 50), (HOUR + 3600, 50)])
+        self.assertEqual(split_delta('monthly', TS, TS + 3600, 100),
+                         [(OCTOBER, 50), (NOVEMBER, 50)])
+
+    def test_rounding(self):
+        parts = split_delta('hourly', TS, TS + 3 * 3600, 100)
+        self.assertEqual(len(parts), 4)
+        self.assertEqual(sum(value for _, value in parts), 100)
+
+    def test_sample_on_boundary(self):
+        self.assertEqual(split_delta('hourly', TS, HOUR + 3600, 100),
+                         [(HOUR, 100)])
+
+
+class HistoryStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'history.db')
+        self.store = HistoryStore(self.filename)
+
+    def tearDown(self):
+        self.store.close()
+        os.remove(self.filename)
+        os.rmdir(self.directory)
+
+    def usages(self, tier):
+        return [tuple(row[i] for i in (0, 4, 5))
+                for row in self.store.report(tier, 0, TS + 86400)]
+
+    def test_delta_split_at_month_end(self):
+        self.store.record(*(KEY + ((TS, 1000, 100),)))
+        self.store.record(*(KEY + ((TS + 3600, 3000, 500),)))
+        self.assertEqual(self.usages('hourly'),
+                         [(HOUR, 1000, 200), (HOUR + 3600, 1000, 200)])
+        self.assertEqual(self.usages('daily'),
+                         [(DAY, 1000, 200), (DAY + 86400, 1000, 200)])
+        self.assertEqual(self.usages('monthly'),
+                         [(OCTOBER, 1000, 200), (NOVEMBER, 1000, 200)])
+
+    def test_counter_reset(self):
+        self.store.record(*(KEY + ((TS, 1000, 100),)))
+        self.store.record(*(KEY + ((TS + 600, 300, 50),)))
+        self.assertEqual(self.usages('hourly'), [(HOUR, 300, 50)])
+
+
+if __name__ == '__main__':
+    unittest.main()
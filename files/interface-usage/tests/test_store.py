@@ -0,0 +1,107 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.store import JsonBucketStore, SqliteBucketStore
+
+KEY = ('router1', 'node1', 'wan1')
+
+# (ts, received, sent) - 128T restarts after ts 300, the bytes between
+# the restart and the first sample after it are not counted
+SERIES = [
+    (100, 0, 0),
+    (200, 10, 5),
+    (300, 20, 8),
+    (400, 3, 2),
+    (500, 7, 4),
+]
+
+
+def as_json(buckets):
+    """Return buckets as they are written to/read from a json file."""
+    return json.loads(json.dumps(buckets))
+
+
+class BucketStoreTests(object):
+    """Replay synthetic counter series through a bucket store."""
+
+    suffix = None
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'buckets' + self.suffix)
+        self.store = self.store_class(self.filename)
+
+    def tearDown(self):
+        self.store.close()
+        for filename in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, filename))
+        os.rmdir(self.directory)
+
+    def replay(self, series, key=KEY):
+        return [self.store.update(*(key + (stats,))) for stats in series]
+
+    def test_running_totals(self):
+        self.replay(SERIES[:3])
+        self.assertEqual(tuple(self.store.get_usage(*KEY)), (20, 8))
+
+    def test_counter_reset(self):
+        first_ts = self.replay(SERIES)
+        self.assertEqual(first_ts, [100] * len(SERIES))
+        self.assertEqual(tuple(self.store.get_usage(*KEY)), (24, 10))
+        self.assertEqual(as_json(self.store.get_buckets(*KEY)), [
+            [[100, 0, 0], [300, 20, 8]],
+            [[400, 3, 2], [500, 7, 4]],
+        ])
+
+    def test_reset_to_zero(self):
+        self.replay([(100, 0, 0), (200, 20, 8), (300, 0, 0), (400, 7, 4)])
+        self.assertEqual(tuple(self.store.get_usage(*KEY)), (27, 12))
+
+    def test_multiple_resets(self):
+        self.replay([(1, 5, 5), (2, 9, 9), (3, 1, 1), (4, 0, 0), (5, 6, 2)])
+        self.assertEqual(tuple(self.store.get_usage(*KEY)), (10, 6))
+
+    def test_unknown_interface(self):
+        self.replay(SERIES)
+        self.assertEqual(tuple(self.store.get_usage('router1', 'node1', 'lte1')),
+                         (0, 0))
+
+    def test_reopen(self):
+        self.replay(SERIES[:4])
+        self.store.close()
+        self.store = self.store_class(self.filename)
+        self.replay(SERIES[4:])
+        self.assertEqual(tuple(self.store.get_usage(*KEY)), (24, 10))
+
+    def test_import_export(self):
+        self.replay(SERIES)
+        self.replay(SERIES[:2], ('router2', 'node1', 'lte1'))
+        exported = self.store.export_buckets()
+        for store_class in (JsonBucketStore, SqliteBucketStore):
+            suffix = '.json' if store_class is JsonBucketStore else '.db'
+            store = store_class(os.path.join(self.directory, 'import' + suffix))
+            store.import_buckets(exported)
+            self.assertEqual(as_json(store.export_buckets()), as_json(exported))
+            self.assertEqual(tuple(store.get_usage(*KEY)), (24, 10))
+            self.assertEqual(
+                tuple(store.get_usage('router2', 'node1', 'lte1')), (10, 5))
+            store.close()
+
+
+class JsonBucketStoreTests(BucketStoreTests, unittest.TestCase):
+    store_class = JsonBucketStore
+    suffix = '.json'
+
+
+class SqliteBucketStoreTests(BucketStoreTests, unittest.TestCase):
+    store_class = SqliteBucketStore
+    suffix = '.db'
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -9,6 +9,10 @@ class UnauthorizedException(Exception):
     pass
 
 
+class ApiException(Exception):
+    pass
+
+
 class RestGraphqlApi(object):
     """Representation of REST connection."""
 
@@ -18,6 +22,8 @@ class RestGraphqlApi(object):
     def __init__(self, host='localhost', verify=False):
         self.host = host
         self.verify = verify
+        # keep connections alive across requests
+        self.session = requests.Session()
 
     def get(self, location, authorization_required=True):
         """Get data per REST API."""
@@ -30,7 +36,7 @@ class RestGraphqlApi(object):
                 self.login()
             if self.token:
                 headers['Authorization'] = 'Bearer {}'.format(self.token)
-        request = requests.get(
+        request = self.session.get(
             url, headers=headers,
             verify=self.verify)
         return request
@@ -47,7 +53,7 @@ class RestGraphqlApi(object):
                 self.login()
             if self.token:
                 headers['Authorization'] = 'Bearer {}'.format(self.token)
-        request = requests.post(
+        request = self.session.post(
             url, headers=headers, json=json,
             verify=self.verify)
         return request
@@ -64,7 +70,7 @@ class RestGraphqlApi(object):
                 self.login()
             if self.token:
                 headers['Authorization'] = 'Bearer {}'.format(self.token)
-        request = requests.patch(
+        request = self.session.patch(
             url, headers=headers, json=json,
             verify=self.verify)
         return request
@@ -98,7 +104,7 @@ class RestGraphqlApi(object):
         # requests_log.setLevel(logging.DEBUG)
         # requests_log.propagate = True
 
-        request = requests.post(
+        request = self.session.post(
             url, headers=headers, json=json,
             verify=self.verify)
         return request
@@ -130,6 +136,47 @@ class RestGraphqlApi(object):
         self.router_name = self.get_routers()[0]['name']
         return self.router_name
 
+    @staticmethod
+    def get_json(request, action):
+        """Return the json of a successful request or raise ApiException."""
+        if request.status_code != 200:
+            raise ApiException('{} failed with HTTP status {}: {}'.format(
+                action, request.status_code, request.text[:200]))
+        try:
+            return request.json()
+        except ValueError:
+            raise ApiException('{} returned no valid json'.format(action))
+
+    def get_config_version(self, datastore='running'):
+        request = self.get('/config/version?datastore={}'.format(datastore))
+        return self.get_json(request, 'Reading the config version').get('version')
+
+    def get_router_inventory(self):
+        """Return all routers with description and nodes in one query."""
+        query = '{ allRouters { nodes { name description nodes { nodes { name role assetId } } } } }'
+        action = 'Querying the router inventory'
+        response = self.get_json(self.query(query), action)
+        if not response.get('data'):
+            raise ApiException('{} failed: {}'.format(
+                action, response.get('errors')))
+        routers = []
+        for router in response['data']['allRouters']['nodes']:
+            routers.append({
+                'name': router['name'],
+                'description': router.get('description'),
+                'nodes': [],
+            })
+            for node in router['nodes']['nodes']:
+                # same keys as the nodes of the REST config api
+                _node = {
+                    'name': node['name'],
+                    'role': (node.get('role') or '').lower(),
+                }
+                if node.get('assetId'):
+                    _node['asset-id'] = node['assetId']
+                routers[-1]['nodes'].append(_node)
+        return routers
+
     def get_nodes(self, router_name):
         return self.get('/config/running/authority/router/{}/node'.format(
             router_name)).json()
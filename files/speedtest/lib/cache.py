@@ -0,0 +1,47 @@
+import json
+import sqlite3
+import time
+
+CACHE_FILE = '/var/lib/128technology/t128-speedtest-cache.db'
+
+
+class ResultsCache(object):
+    """Speedtest results published by the routers in a sqlite database.
+
+    The latest results of every router are stored by its asset id, so the
+    collector can read them without contacting the minions.
+    """
+
+    schema = '''
+        CREATE TABLE IF NOT EXISTS results (
+            asset_id TEXT NOT NULL PRIMARY KEY,
+            received INTEGER NOT NULL,
+            results TEXT NOT NULL
+        );
+    '''
+
+    def __init__(self, filename=CACHE_FILE):
+        # the receiver writes while the collector reads - wait for locks
+        self.db = sqlite3.connect(filename, timeout=30)
+        self.db.executescript(self.schema)
+
+    def store(self, asset_id, results, received=None):
+        """Replace the results of an asset."""
+        if not received:
+            received = int(time.time())
+        with self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO results VALUES (?, ?, ?)',
+                (asset_id, received, json.dumps(results)))
+
+    def retrieve_results(self, asset_ids):
+        """Yield (asset_id, results dict) of the cached assets."""
+        for asset_id in asset_ids:
+            row = self.db.execute(
+                'SELECT results FROM results WHERE asset_id = ?',
+                (asset_id,)).fetchone()
+            if row:
+                yield asset_id, json.loads(row[0])
+
+    def close(self):
+        self.db.close()
@@ -1,4 +1,7 @@
 import subprocess
 
 def run_command(command):
-    return subprocess.run(command.split(), stdout=subprocess.PIPE)
+    """Run a command string (split at whitespace) or an argument list."""
+    if isinstance(command, str):
+        command = command.split()
+    return subprocess.run(command, stdout=subprocess.PIPE)
@@ -1,21 +1,68 @@
 import json
 
 import salt.client
+import salt.config
+import salt.utils.event
+
+from lib.log import warning
+
+MASTER_CONFIG = '/etc/128technology/salt/master'
+RESULTS_TAG = 't128/speedtest/results'
+
 
 def run(asset_id, cmd):
     """Run a command on salt minion."""
-    local = salt.client.LocalClient('/etc/128technology/salt/master')
+    local = salt.client.LocalClient(MASTER_CONFIG)
     result = local.cmd(asset_id, 'cmd.run', [cmd])[asset_id]
     if 'command not found' in result:
-        warn('Error on node:', asset_id, result)
+        warning('Error on node:', asset_id, result)
     return result
 
-def retrieve_result(asset_id, results_file):
-    results = {}
-    cmd = 'cat {}'.format(results_file)
+
+def parse_result(asset_id, result):
+    """Return the results dict of a minion's cat output or None."""
+    if not isinstance(result, str):
+        return None
+    if 'command not found' in result:
+        warning('Error on node:', asset_id, result)
     try:
-        result = run(asset_id, cmd)
-        results_dict = json.loads(result)
-        return results_dict
+        return json.loads(result)
     except json.JSONDecodeError:
         return None
+
+
+def retrieve_results(asset_ids, results_file, timeout=60):
+    """Yield (asset_id, results dict) as the minions respond.
+
+    All minions are targeted by one list target through a single client,
+    minions which do not respond within timeout seconds are not yielded.
+    """
+    asset_ids = list(asset_ids)
+    if not asset_ids:
+        return
+    local = salt.client.LocalClient(MASTER_CONFIG)
+    cmd = 'cat {}'.format(results_file)
+    for response in local.cmd_iter(asset_ids, 'cmd.run', [cmd],
+                                   tgt_type='list', timeout=timeout):
+        for asset_id, data in response.items():
+            yield asset_id, parse_result(asset_id, data.get('ret'))
+
+
+def receive_results(tag=RESULTS_TAG):
+    """Yield (asset_id, results dict) of events on the master event bus.
+
+    Runners send their results by 'salt-call event.send'.
+    """
+    opts = salt.config.client_config(MASTER_CONFIG)
+    event_bus = salt.utils.event.get_master_event(
+        opts, opts['sock_dir'], listen=True)
+    for event in event_bus.iter_events(tag=tag, full=True,
+                                       auto_reconnect=True):
+        data = event.get('data', {})
+        asset_id = data.get('id')
+        payload = data.get('data')
+        results = payload.get('results') if isinstance(payload, dict) else None
+        if not asset_id or not isinstance(results, dict):
+            warning('Ignoring invalid results event:', str(data)[:200])
+            continue
+        yield asset_id, results
@@ -20,7 +20,8 @@ def run_speedtest(namespace, server_id=None):
 
 def get_results(interface, interface_stats, max_delay):
     namespace = 'speed-{}'.format(interface).lower()
-    delay = random.randint(0, max_delay)
-    info('Delay speedtest execution by {} seconds.'.format(delay))
-    time.sleep(delay)
+    if max_delay:
+        delay = random.randint(0, max_delay)
+        info('Delay speedtest execution by {} seconds.'.format(delay))
+        time.sleep(delay)
     return run_speedtest(namespace)
@@ -2,24 +2,31 @@
 
 import argparse
 import json
+import os
 import time
 
 from lib import salt
 from lib.log import *
 from lib import log
-from lib.api import RestGraphqlApi
+from lib.api import ApiException, RestGraphqlApi
+from lib.cache import CACHE_FILE, ResultsCache
 
 
 def parse_arguments():
     """Get commandline arguments."""
     parser = argparse.ArgumentParser(
         description='Collect speedtest measurements and update conductor.')
+    parser.add_argument('--cache', action='store_true', help='read results published by the runners from the cache file instead of the minions')
+    parser.add_argument('--cache-file', default=CACHE_FILE)
     parser.add_argument('--debug', action='store_true')
     parser.add_argument('--host', default='localhost')
+    parser.add_argument('--inventory-file', default='/var/lib/128technology/t128-speedtest-inventory.json', help='cache of routers and nodes (per config version)')
     parser.add_argument('--log-file', default=log.LOGFILE)
     parser.add_argument('--max-age', default=12, type=int, help='maximum age of speedtest results (in hours)')
+    parser.add_argument('--receive', action='store_true', help='store results published by the runners in the cache file (runs forever)')
     parser.add_argument('--results-file', default='/var/lib/128technology/t128-speedtest-results.json')
     parser.add_argument('--router', action='append', default=[])
+    parser.add_argument('--timeout', default=60, type=int, help='seconds to wait for minions to return their results')
     args = parser.parse_args()
     return args
 
@@ -32,7 +39,35 @@ def has_uncommitted_changes(api):
     return request.json()['isDirty']
 
 
+def get_router_inventory(api, inventory_file):
+    """Return routers and their nodes - cached by running config version."""
+    version = api.get_config_version()
+    try:
+        with open(inventory_file) as fd:
+            inventory = json.load(fd)
+        if version and inventory.get('version') == version:
+            debug('Using router inventory of config version', str(version))
+            return inventory['routers']
+    except (IOError, ValueError, KeyError):
+        pass
+    routers = api.get_router_inventory()
+    if version:
+        tmp_file = inventory_file + '.tmp'
+        with open(tmp_file, 'w') as fd:
+            json.dump({'version': version, 'routers': routers}, fd)
+        os.rename(tmp_file, inventory_file)
+    return routers
+
+
 def update_descriptions(api, descriptions):
+    """Patch the changed descriptions into the candidate config and commit.
+
+    The patches share the keep-alive session of the api, the changes are
+    committed once at the end.
+    """
+    if not descriptions:
+        info('No router descriptions have changed.')
+        return
     for router, description in descriptions:
         location = '/config/candidate/authority/router/{}'.format(router)
         info('Updating description for router {}: {}'.format(router, description))
@@ -40,10 +75,45 @@ def update_descriptions(api, descriptions):
     api.post('/config/commit', {})
 
 
-def process_routers(api, results_file, routers, max_age, prefix='(Speedtest:', suffix=')'):
+def format_description(router_name, description, results_dict, max_age,
+                       prefix='(Speedtest:', suffix=')'):
+    """Return the router description with the speedtest results or None."""
+    interface_strings = []
+    for module, module_results in results_dict.items():
+        for interface, interface_results in module_results.items():
+            if not interface_results.get('download') or \
+               not interface_results.get('upload'):
+                continue
+            if interface_results.get('ts') + max_age * 3600 < time.time():
+                info('Ignoring too old results for router:', router_name)
+                continue
+            download = int(interface_results['download']['bandwidth']*8/1000000)
+            upload = int(interface_results['upload']['bandwidth']*8/1000000)
+            interface_strings.append('{}: {} Mbps down, {} Mbps up'.format(
+                interface, download, upload))
+
+    if not interface_strings:
+        return None
+    interface_description = '{} {}{}'.format(
+        prefix, ' | '.join(interface_strings), suffix)
+    # TODO: regex to replace substring
+    description = (description or '').split(prefix)[0].strip(' ')
+    if description:
+        return '{} {}'.format(description, interface_description)
+    return interface_description
+
+
+def receive_results(cache):
+    """Store results published on the salt event bus in the cache."""
+    for asset_id, results_dict in salt.receive_results():
+        info('Received results from asset:', asset_id)
+        cache.store(asset_id, results_dict)
+
+
+def process_routers(api, inventory, retrieve_results, routers, max_age):
     """Iterate over routers and update the description field accordingly."""
-    descriptions = []
-    for router in api.get_routers():
+    assets = {}
+    for router in inventory:
         router_name = router['name']
         debug('Process router:', router_name)
 
@@ -51,16 +121,14 @@ def process_routers(api, results_file, routers, max_age, prefix='(Speedtest:', s
         if routers and router_name not in routers:
             continue
 
-        description = router['description']
-        nodes = api.get_nodes(router_name)
+        nodes = router['nodes']
         if len(nodes) != 1:
             # How to handle more than one router node? Log a warning!
-            warn('The script supports only routers with one node:',
-                 router_name)
+            warning('The script supports only routers with one node:',
+                    router_name)
             continue
 
         node = nodes[0]
-        node_name = node['name']
         if node['role'] == 'conductor':
             # ignore conductor nodes
             continue
@@ -70,39 +138,26 @@ def process_routers(api, results_file, routers, max_age, prefix='(Speedtest:', s
         except KeyError:
             # ignore nodes without asset_id
             continue
-        results_dict = salt.retrieve_result(asset_id, results_file)
-        if not results_dict:
+        assets[asset_id] = router
+
+    # retrieve the results of all routers at once and handle each router
+    # as soon as its minion responds (or read them from the cache)
+    descriptions = []
+    for asset_id, results_dict in retrieve_results(list(assets)):
+        router = assets.pop(asset_id, None)
+        if not router or not results_dict:
             continue
         debug('results_dict for asset {}: {}'.format(asset_id, results_dict))
-
-        interface_strings = []
-        for module, module_results in results_dict.items():
-            for interface, interface_results in module_results.items():
-                if not interface_results.get('download') or \
-                   not interface_results.get('upload'):
-                    continue
-                if interface_results.get('ts') + max_age * 3600 < time.time():
-                    info('Ignoring too old results for router:', router_name)
-                    continue
-                download = int(interface_results['download']['bandwidth']*8/1000000)
-                upload = int(interface_results['upload']['bandwidth']*8/1000000)
-                interface_strings.append('{}: {} Mbps down, {} Mbps up'.format(
-                    interface, download, upload))
-
-        if interface_strings:
-            interface_description = '{} {}{}'.format(
-                prefix, ' | '.join(interface_strings), suffix)
-            if description:
-                # TODO: regex to replace substring
-                description = '{} {}'.format(
-                    description.split(prefix)[0].strip(' '),
-                    interface_description)
-            else:
-                description = interface_description
+        description = format_description(
+            router['name'], router['description'], results_dict, max_age)
+        if description and description != router['description']:
             descriptions.append((
-                router_name,
+                router['name'],
                 description,
             ))
+    for asset_id, router in assets.items():
+        debug('No results from asset {} (router {})'.format(
+            asset_id, router['name']))
     debug('Descriptions: {}'.format(descriptions))
     update_descriptions(api, descriptions)
 
@@ -111,13 +166,37 @@ def main():
     args = parse_arguments()
     log.DEBUG = args.debug
     log.LOGFILE = args.log_file
+    if args.receive:
+        cache = ResultsCache(args.cache_file)
+        try:
+            receive_results(cache)
+        finally:
+            cache.close()
+        return
+
     api = RestGraphqlApi(args.host)
 
     if has_uncommitted_changes(api):
         fatal('Conductor has uncommitted changes.',
               'Quit here to avoid commit conflicts.')
 
-    process_routers(api, args.results_file, args.router, args.max_age)
+    cache = None
+    if args.cache:
+        cache = ResultsCache(args.cache_file)
+        retrieve_results = cache.retrieve_results
+    else:
+        def retrieve_results(asset_ids):
+            return salt.retrieve_results(
+                asset_ids, args.results_file, args.timeout)
+    try:
+        inventory = get_router_inventory(api, args.inventory_file)
+        process_routers(api, inventory, retrieve_results, args.router,
+                        args.max_age)
+    except ApiException as e:
+        fatal(str(e))
+    finally:
+        if cache:
+            cache.close()
 
 
 if __name__ == '__main__':
@@ -1,23 +1,31 @@
 #!/usr/bin/env python3
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import json
+import random
 import time
 
 from lib.log import *
 from lib import log
 from lib.api import RestGraphqlApi
+from lib.cmd import run_command
 import plugins
 
+RESULTS_TAG = 't128/speedtest/results'
+
 
 def parse_arguments():
     """Get commandline arguments."""
     parser = argparse.ArgumentParser(
         description='Run speedtest and write results to json file.')
+    parser.add_argument('--concurrency', type=int, default=1, help='maximum number of tests running at the same time')
     parser.add_argument('--debug', action='store_true')
+    parser.add_argument('--group', action='append', default=[], help='comma separated interfaces sharing an uplink (never tested at the same time)')
     parser.add_argument('--host', default='localhost')
     parser.add_argument('--log-file', default=log.LOGFILE)
     parser.add_argument('--max-delay', type=int, default=0)
+    parser.add_argument('--publish', action='store_true', help='send results to the conductor (salt event bus)')
     parser.add_argument('--results-file', default='/var/lib/128technology/t128-speedtest-results.json')
     parser.add_argument('--test', action='append', default=[])
     args = parser.parse_args()
@@ -49,18 +57,20 @@ def write_results(filename, results):
         json.dump(results, fd)
 
 
-def main():
-    args = parse_arguments()
-    log.DEBUG = args.debug
-    log.LOGFILE = args.log_file
-    results = {}
-    stats = get_interface_stats(args.host)
-    plugins.load_plugins()
-    # iterate over plugins and run get_results for each plugin
-    # which is configured and where assigned interfaces are UP
+def publish_results(results):
+    """Send results as salt event to the master's event bus."""
+    data = 'data={}'.format(json.dumps({'results': results}))
+    result = run_command(['salt-call', 'event.send', RESULTS_TAG, data])
+    if result.returncode != 0:
+        warning('Could not publish results to the conductor.')
+
+
+def get_jobs(tests, stats):
+    """Return (plugin, interface) of all tests on interfaces which are UP."""
+    jobs = []
     for plugin in plugins.plugins:
         test_interfaces = [
-            x.split(':')[1] for x in args.test if x.startswith(plugin.name)
+            x.split(':')[1] for x in tests if x.startswith(plugin.name)
         ]
         for interface in test_interfaces:
             if interface not in stats:
@@ -69,13 +79,60 @@ def main():
             if not stats[interface]['up']:
                 debug('Interface', interface, 'is down - skipping')
                 continue
-            _interface = interface.replace('local-wan', 'wan')
-            result = plugin.get_results(_interface, stats, args.max_delay)
-            result['ts'] = int(time.time())
-            if plugin.name not in results:
-                results[plugin.name] = {}
-            results[plugin.name][interface] = result
+            jobs.append((plugin, interface))
+    return jobs
+
+
+def schedule_jobs(jobs, groups):
+    """Split jobs into lanes - jobs of a shared-uplink group share a lane."""
+    group_of = {}
+    for group in groups:
+        for interface in group.split(','):
+            group_of[interface.strip()] = group
+    lanes = {}
+    for plugin, interface in jobs:
+        lane = group_of.get(interface, interface)
+        lanes.setdefault(lane, []).append((plugin, interface))
+    return list(lanes.values())
+
+
+def run_lane(lane, stats):
+    """Run the tests of a lane one after another."""
+    results = []
+    for plugin, interface in lane:
+        _interface = interface.replace('local-wan', 'wan')
+        # the global jitter has already been applied - no per-test delay
+        result = plugin.get_results(_interface, stats, 0)
+        result['ts'] = int(time.time())
+        results.append((plugin.name, interface, result))
+    return results
+
+
+def main():
+    args = parse_arguments()
+    log.DEBUG = args.debug
+    log.LOGFILE = args.log_file
+    results = {}
+    stats = get_interface_stats(args.host)
+    plugins.load_plugins()
+    # run get_results for each plugin which is configured and where
+    # assigned interfaces are UP - tests on independent interfaces run
+    # concurrently, tests of a shared-uplink group one after another
+    lanes = schedule_jobs(get_jobs(args.test, stats), args.group)
+    if lanes:
+        delay = random.randint(0, args.max_delay)
+        info('Delay speedtest execution by {} seconds.'.format(delay))
+        time.sleep(delay)
+    with ThreadPoolExecutor(max(1, args.concurrency)) as executor:
+        for lane_results in executor.map(
+                lambda lane: run_lane(lane, stats), lanes):
+            for plugin_name, interface, result in lane_results:
+                if plugin_name not in results:
+                    results[plugin_name] = {}
+                results[plugin_name][interface] = result
     write_results(args.results_file, results)
+    if args.publish:
+        publish_results(results)
 
 
 if __name__ == '__main__':
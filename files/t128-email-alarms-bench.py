@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+"""Benchmark t128-email-alarms-ha.py end-to-end on localhost.
+
+A mock conductor (event stream and GraphQL interface descriptions) and
+an SMTP sink are started locally. The mailer is run against them as a
+subprocess, synthetic or recorded alarms are streamed at a given rate
+and the time from sending an event to receiving its mail is measured.
+
+Example:
+
+    ./t128-email-alarms-bench.py --alarms 5000 --rate 500 --engine asyncio
+"""
+
+import argparse
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import os
+import re
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def parse_arguments():
+    """Get commandline arguments."""
+    parser = argparse.ArgumentParser(
+        description='Benchmark the alarm mailer against a local mock '
+                    'conductor and SMTP sink.')
+    parser.add_argument('--script', help='mailer script',
+                        default=os.path.join(
+                            SCRIPT_DIR, 't128-email-alarms-ha.py'))
+    parser.add_argument('--python', default=sys.executable,
+                        help='python interpreter to run the mailer')
+    parser.add_argument('--engine', choices=('threads', 'asyncio'),
+                        default='threads', help='mailer engine')
+    parser.add_argument('--alarms', type=int, default=1000,
+                        help='number of synthetic alarms')
+    parser.add_argument('--stream', help='replay a recorded event stream '
+                        '(like alarms-stream.txt) instead')
+    parser.add_argument('--rate', type=float, default=100,
+                        help='events per second (0 = as fast as possible)')
+    parser.add_argument('--routers', type=int, default=50,
+                        help='number of routers of synthetic alarms')
+    parser.add_argument('--recipients', type=int, default=4,
+                        help='number of distinct recipients lists')
+    parser.add_argument('--mail-interval', type=int, default=0,
+                        help='mail_interval of the mailer')
+    parser.add_argument('--digest', action='store_true',
+                        help='send digest mails')
+    parser.add_argument('--graphql-delay', type=float, default=0,
+                        help='delay of graphql responses in ms')
+    parser.add_argument('--smtp-delay', type=float, default=0,
+                        help='delay of smtp responses in ms')
+    parser.add_argument('--timeout', type=float, default=60,
+                        help='seconds to wait for mails after the last event')
+    parser.add_argument('--config', metavar='KEY=VALUE', action='append',
+                        default=[], help='additional mailer config '
+                        '(value is parsed as json if possible)')
+    parser.add_argument('--show-output', action='store_true',
+                        help='show the output of the mailer')
+    return parser.parse_args()
+
+
+def synthetic_events(count, routers):
+    """Return a storm of ADD alarms on device interfaces."""
+    events = []
+    for i in range(count):
+        router = 'router{}'.format(i % routers)
+        events.append({
+            'type': 'alarm',
+            'subtype': 'ADD',
+            'alarm': {
+                'id': 'bench-{}'.format(i),
+                'router': router,
+                'node': 'node1',
+                'category': 'INTERFACE',
+                'severity': 'MAJOR',
+                'process': 'highway',
+                'source': 'bench',
+                'shelvedStatus': 'NOTSHELVED',
+                'message': 'Interface down | DeviceName: wan{} | {}'.format(
+                    i % 4, i),
+            },
+        })
+    return events
+
+
+def recorded_events(filename):
+    """Return the events of a recorded event stream."""
+    events = []
+    data = []
+    with open(filename) as fd:
+        for line in fd:
+            line = line.rstrip('\r\n')
+            if line.startswith('data:'):
+                data.append(line[5:].lstrip(' '))
+            elif not line and data:
+                events.append(json.loads('\n'.join(data)))
+                data = []
+    if data:
+        events.append(json.loads('\n'.join(data)))
+    return events
+
+
+class MockConductor(socketserver.ThreadingMixIn, HTTPServer):
+    """Serve the event stream and interface descriptions."""
+
+    # the event stream never ends
+    daemon_threads = True
+
+    def __init__(self, events, rate, graphql_delay):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), MockConductorHandler)
+        self.events = events
+        self.rate = rate
+        self.graphql_delay = graphql_delay
+        self.sent = {}
+        self.sent_count = 0
+        self.done = threading.Event()
+        self.connects = 0
+        self.graphql_requests = 0
+        self.lock = threading.Lock()
+
+
+class MockConductorHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if not self.path.startswith('/api/v1/events'):
+            self.send_error(404)
+            return
+        server = self.server
+        with server.lock:
+            server.connects += 1
+        start = 0
+        last_id = self.headers.get('Last-Event-ID')
+        if last_id and last_id.isdigit():
+            start = int(last_id) + 1
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.write_chunk(': bench\n\n')
+
+        begin = time.time()
+        for i in range(start, len(server.events)):
+            if server.rate:
+                delay = begin + (i - start) / server.rate - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            event = server.events[i]
+            alarm_id = event.get('alarm', {}).get('id')
+            with server.lock:
+                server.sent.setdefault(alarm_id, time.time())
+                server.sent_count += 1
+            self.write_chunk('id: {}\ndata: {}\n\n'.format(
+                i, json.dumps(event)))
+        server.done.set()
+        # keep the stream open like the conductor does
+        while True:
+            time.sleep(5)
+            self.write_chunk(': keep-alive\n\n')
+
+    def write_chunk(self, data):
+        data = data.encode('utf-8')
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        self.wfile.flush()
+
+    def do_POST(self):
+        if not self.path.startswith('/api/v1/graphql'):
+            self.send_error(404)
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        query = json.loads(self.rfile.read(length).decode('utf-8'))['query']
+        with self.server.lock:
+            self.server.graphql_requests += 1
+        if self.server.graphql_delay:
+            time.sleep(self.server.graphql_delay / 1000.0)
+        data = {}
+        selections = re.findall(
+            r'(?:(\w+): )?allRouters\(name: "([^"]*)"\).*?'
+            r'deviceInterfaces\(name: "([^"]*)"\)', query)
+        for alias, router, interface in selections:
+            data[alias or 'allRouters'] = {'nodes': [{'nodes': {'nodes': [{
+                'deviceInterfaces': {'nodes': [{
+                    'description': '{} {}'.format(router, interface)}]},
+            }]}}]}
+        body = json.dumps({'data': data}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class SmtpSink(socketserver.ThreadingTCPServer):
+    """Accept mails and remember when each alarm id was mailed."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, delay):
+        socketserver.ThreadingTCPServer.__init__(
+            self, ('127.0.0.1', 0), SmtpSinkHandler)
+        self.delay = delay
+        self.received = {}
+        self.mails = 0
+        self.connections = 0
+        self.lock = threading.Lock()
+
+
+class SmtpSinkHandler(socketserver.StreamRequestHandler):
+
+    def reply(self, line):
+        if self.server.delay:
+            time.sleep(self.server.delay / 1000.0)
+        self.wfile.write(line + b'\r\n')
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        self.reply(b'220 bench')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line[:4].upper()
+            if command == b'DATA':
+                self.reply(b'354 go ahead')
+                self.receive_mail()
+                self.reply(b'250 ok')
+            elif command == b'QUIT':
+                self.reply(b'221 bye')
+                return
+            elif command == b'EHLO':
+                self.reply(b'250-bench\r\n250 8BITMIME')
+            else:
+                self.reply(b'250 ok')
+
+    def receive_mail(self):
+        ids = []
+        for line in self.rfile:
+            if line in (b'.\r\n', b'.\n'):
+                break
+            if line.startswith(b'Alarm ID:'):
+                ids.append(line[9:].strip().decode('utf-8'))
+        now = time.time()
+        with self.server.lock:
+            self.server.mails += 1
+            for alarm_id in ids:
+                self.server.received.setdefault(alarm_id, now)
+
+
+def percentile(values, p):
+    """Return the p-th percentile of sorted values."""
+    if not values:
+        return 0
+    index = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def write_config(args, conductor, sink, directory):
+    """Write the mailer config pointing at the local servers."""
+    recipients = {'default': 'bench-default@localhost'}
+    for i in range(args.routers):
+        recipients['router{}'.format(i)] = 'bench-{}@localhost'.format(
+            i % args.recipients)
+    config = {
+        'api_host': '127.0.0.1:{}'.format(conductor.server_port),
+        'api_scheme': 'http',
+        'api_key': 'bench',
+        'mail_host': '127.0.0.1',
+        'mail_port': sink.server_address[1],
+        'mail_from': 'bench@localhost',
+        'mail_recipients': recipients,
+        'mail_interval': args.mail_interval,
+        'mail_digest': args.digest,
+        'template': os.path.join(SCRIPT_DIR, 't128-email-alarms-ha.template'),
+        'digest_template': os.path.join(
+            SCRIPT_DIR, 't128-email-alarms-ha-digest.template'),
+        'journal_file': os.path.join(directory, 'journal.db'),
+    }
+    for item in args.config:
+        key, _, value = item.partition('=')
+        try:
+            config[key] = json.loads(value)
+        except ValueError:
+            config[key] = value
+    filename = os.path.join(directory, 'config.json')
+    with open(filename, 'w') as fd:
+        json.dump(config, fd)
+    return filename
+
+
+def main():
+    args = parse_arguments()
+    if args.stream:
+        events = recorded_events(args.stream)
+    else:
+        events = synthetic_events(args.alarms, args.routers)
+
+    conductor = MockConductor(events, args.rate, args.graphql_delay)
+    sink = SmtpSink(args.smtp_delay)
+    for server in (conductor, sink):
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    directory = tempfile.mkdtemp(prefix='t128-email-alarms-bench-')
+    config_file = write_config(args, conductor, sink, directory)
+    output = None if args.show_output else subprocess.DEVNULL
+    mailer = subprocess.Popen(
+        [args.python, '-u', args.script, '--config-file', config_file,
+         '--engine', args.engine], cwd=directory,
+        stdout=output, stderr=output)
+    try:
+        start = time.time()
+        while not conductor.done.wait(1):
+            if mailer.poll() is not None:
+                sys.exit('Mailer exited with code {}'.format(mailer.returncode))
+        # wait until no more mails arrive
+        last_mails = -1
+        deadline = time.time() + args.timeout
+        while time.time() < deadline:
+            time.sleep(max(1, args.mail_interval))
+            with sink.lock:
+                complete = len(sink.received) >= len(conductor.sent)
+                mails = sink.mails
+            if complete or (mails == last_mails and mails):
+                break
+            last_mails = mails
+        end = time.time()
+    finally:
+        mailer.terminate()
+        mailer.wait()
+
+    with sink.lock, conductor.lock:
+        latencies = sorted(
+            sink.received[alarm_id] - sent
+            for alarm_id, sent in conductor.sent.items()
+            if alarm_id in sink.received)
+        last_mail = max(sink.received.values()) if sink.received else end
+        print('engine:            {}'.format(args.engine))
+        print('events sent:       {}'.format(conductor.sent_count))
+        print('alarms mailed:     {} of {}'.format(
+            len(latencies), len(conductor.sent)))
+        print('mails:             {}'.format(sink.mails))
+        print('smtp connections:  {}'.format(sink.connections))
+        print('graphql requests:  {}'.format(conductor.graphql_requests))
+        print('stream connects:   {}'.format(conductor.connects))
+        duration = last_mail - start
+        print('duration:          {:.3f} s'.format(duration))
+        print('throughput:        {:.1f} alarms/s'.format(
+            len(latencies) / duration if duration > 0 else 0))
+        for p in (50, 90, 99, 100):
+            print('latency p{:<3}      {:.3f} s'.format(
+                p, percentile(latencies, p)))
+
+
+if __name__ == '__main__':
+    main()
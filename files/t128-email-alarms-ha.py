@@ -2,12 +2,18 @@
 
 from __future__ import print_function
 import argparse
+import calendar
+from collections import OrderedDict
+from contextlib import contextmanager
 import json
 import os
+import random
+import re
 import requests
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 import smtplib
-from subprocess import check_call, check_output, CalledProcessError
+import socket
+import sqlite3
 import sys
 import threading
 import time
@@ -15,27 +21,44 @@ import time
 from jinja2 import Template
 
 # Python 2 backwards compatibility
-try:
-    from subprocess import DEVNULL  # python3
-except ImportError:
-    # python2
-    import os
-    DEVNULL = open(os.devnull, 'wb')
-
 try:
     FileNotFoundError  # python3
 except NameError:
     FileNotFoundError = IOError
 
+try:
+    import queue  # python3
+except ImportError:
+    import Queue as queue
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 DEBUG = False
 TESTING = False
 DRY_RUN = False
 config = None
+config_file = None
 mail_interval = 60
 template = None
+digest_template = None
+smtp_pool = None
+api_session = None
+description_cache = None
+journal = None
+leadership = None
+metrics = None
+rule_engine = None
 alarms = []
+# set by the receiver when alarms should be processed immediately
+alarms_event = threading.Event()
+rule_engine_lock = threading.Lock()
+mail_queues = []
 cleaned_duplicates = 0
+# hashes of recently seen alarms (across intervals): hash -> expiry time
+seen_hashes_cache = OrderedDict()
 
 
 def parse_arguments():
@@ -50,6 +73,22 @@ def parse_arguments():
                         action='store_true')
     parser.add_argument('--testing', help='enable testing mode',
                         action='store_true')
+    parser.add_argument('--query', action='store_true',
+                        help='print alarms from the journal and exit')
+    parser.add_argument('--alarm-id', help='query: alarm id')
+    parser.add_argument('--router', help='query: router name')
+    parser.add_argument('--since', help='query: start time (UTC) as '
+                        'YYYY-MM-DD[THH:MM] or unix timestamp')
+    parser.add_argument('--until', help='query: end time (UTC) as '
+                        'YYYY-MM-DD[THH:MM] or unix timestamp')
+    parser.add_argument('--limit', type=int, default=100,
+                        help='query: maximum number of alarms')
+    parser.add_argument('--benchmark', metavar='N', type=int, nargs='?',
+                        const=1, help='replay alarms-stream.txt N times '
+                        'through the filters and report alarms/sec')
+    parser.add_argument('--engine', choices=('threads', 'asyncio'),
+                        default='threads',
+                        help='processing engine (asyncio needs python 3)')
     return parser.parse_args()
 
 
@@ -59,6 +98,15 @@ def read_json(filename):
         return json.load(fd)
 
 
+def check_config(config):
+    """Exit on config values the mailer cannot work with."""
+    for key in ('mail_workers', 'mail_connections'):
+        value = config.get(key, 4)
+        if not isinstance(value, int) or value < 1:
+            fatal('Invalid {} in config file: {} (must be 1 or more)'.format(
+                key, value))
+
+
 def log(*messages):
     """Log a message."""
     print(*messages)
@@ -87,68 +135,316 @@ def testing(*messages):
         log('TESTING:', *messages)
 
 
-def get_host_ips():
-    """Return a list of IP addresses of the host that runs the script."""
-    ips = check_output(['hostname', '--all-ip-addresses']).decode('utf8')
-    return ips.split()
-
+class Metrics(object):
+    """Counters, histograms and gauges in the Prometheus text format.
+
+    Gauges are callables which are evaluated on each scrape.
+    """
+
+    buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+               30, 60, 120, 300)
+    declarations = (
+        ('received_total', 'counter', 'Alarms received from the event stream'),
+        ('ignored_total', 'counter', 'Alarms ignored by reason'),
+        ('deduplicated_total', 'counter', 'Duplicate alarms removed'),
+        ('cleared_total', 'counter',
+         'Alarms removed because they were added and cleared in an interval'),
+        ('mailed_total', 'counter', 'Alarms sent via mail'),
+        ('failed_total', 'counter', 'Alarms whose mail could not be sent'),
+        ('mails_total', 'counter', 'Mails by result'),
+        ('queue_delay_seconds', 'histogram',
+         'Time between receiving and processing an alarm'),
+        ('stage_seconds', 'histogram', 'Duration of processing stages'),
+        ('graphql_request_seconds', 'histogram',
+         'Duration of interface description lookups'),
+        ('smtp_send_seconds', 'histogram', 'Duration of sending a mail'),
+    )
 
-def ping_node(address):
-    """Ping a node."""
-    cmd = 'ping -c 1 -w 1 -q'.split(' ')
-    cmd.append(address)
-    debug('Ping result:', check_call(cmd, stdout=DEVNULL))
+    def __init__(self, prefix='t128_email_alarms'):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.metrics = OrderedDict()
+        for name, metric_type, help_text in self.declarations:
+            self.metrics[name] = (metric_type, help_text, OrderedDict())
+        self.gauges = OrderedDict()
+
+    def inc(self, name, value=1, **labels):
+        """Increase a counter."""
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            samples = self.metrics[name][2]
+            samples[key] = samples.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """Add a value to a histogram."""
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            samples = self.metrics[name][2]
+            if key not in samples:
+                samples[key] = [[0] * len(self.buckets), 0.0, 0]
+            histogram = samples[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observe the duration of a with block."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def gauge(self, name, help_text, func):
+        """Register a gauge whose value is returned by func."""
+        self.gauges[name] = (help_text, func)
+
+    @staticmethod
+    def format_labels(labels):
+        if not labels:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(
+            k, str(v).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n')) for k, v in labels) + '}'
+
+    def render(self):
+        """Return all metrics in the Prometheus text format."""
+        lines = []
+        with self.lock:
+            for name, (metric_type, help_text, samples) in \
+                    self.metrics.items():
+                name = '{}_{}'.format(self.prefix, name)
+                lines.append('# HELP {} {}'.format(name, help_text))
+                lines.append('# TYPE {} {}'.format(name, metric_type))
+                if metric_type == 'counter':
+                    for labels, value in samples.items():
+                        lines.append('{}{} {}'.format(
+                            name, self.format_labels(labels), value))
+                    continue
+                for labels, (counts, total, count) in samples.items():
+                    for bound, bucket_count in zip(self.buckets, counts):
+                        lines.append('{}_bucket{} {}'.format(
+                            name, self.format_labels(
+                                labels + (('le', bound),)), bucket_count))
+                    lines.append('{}_bucket{} {}'.format(
+                        name, self.format_labels(labels + (('le', '+Inf'),)),
+                        count))
+                    lines.append('{}_sum{} {}'.format(
+                        name, self.format_labels(labels), total))
+                    lines.append('{}_count{} {}'.format(
+                        name, self.format_labels(labels), count))
+        for name, (help_text, func) in self.gauges.items():
+            name = '{}_{}'.format(self.prefix, name)
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} gauge'.format(name))
+            try:
+                lines.append('{} {}'.format(name, float(func())))
+            except Exception as e:
+                debug('Could not read gauge {}: {}'.format(name, e))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serve the metrics on /metrics."""
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        debug('metrics:', format % args)
+
+
+def start_metrics_server(address, port):
+    """Serve metrics in a background thread."""
+    server = HTTPServer((address, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    info('Serving metrics on {}:{}'.format(address or '*', port))
+    return server
+
+
+def register_gauges():
+    """Register gauges of the queues and caches."""
+    metrics.gauge('pending_alarms', 'Alarms waiting for the next interval',
+                  lambda: len(alarms))
+    metrics.gauge('mail_queue_depth', 'Mails waiting to be sent',
+                  lambda: sum(q.qsize() for q in mail_queues))
+    metrics.gauge('seen_hashes', 'Alarm hashes kept for duplicate detection',
+                  lambda: len(seen_hashes_cache))
+    metrics.gauge('description_cache_entries',
+                  'Cached interface descriptions',
+                  lambda: len(description_cache.entries))
+    metrics.gauge('active', 'Whether this node is the active HA node',
+                  node_is_active)
+
+
+def is_local_address(address):
+    """Return true if address is assigned to this host.
+
+    Binding a socket only succeeds for local addresses, which avoids
+    forking external tools to list the host's addresses.
+    """
+    family = socket.AF_INET6 if ':' in address else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    try:
+        sock.bind((address, 0))
+        return True
+    except socket.error:
+        return False
+    finally:
+        sock.close()
 
 
-def node_is_active():
-    """Return true on active node."""
-    # lexically sort node names:
-    # * return True if we are the first one
-    # * else return True if the other peer is unreachable
+def probe_address(address, port, timeout):
+    """Return true if a tcp connection to address:port can be opened."""
     try:
-        global_init = read_json('/etc/128technology/global.init')
-    except FileNotFoundError:
+        sock = socket.create_connection((address, port), timeout)
+        sock.close()
+        return True
+    except socket.error:
+        return False
+
+
+class HaLeadership(object):
+    """Decide whether this conductor node is the active HA node.
+
+    The conductors in global.init are lexically sorted by name. The first
+    one is always active, the second one only if the first is down.
+    global.init is only re-read when its mtime changes. The peer is probed
+    by a background thread; it is considered down after down_threshold
+    failed probes and up again after up_threshold successful ones, so
+    is_active() is a plain memory read and does not flap.
+    """
+
+    def __init__(self, global_init='/etc/128technology/global.init',
+                 probe_port=443, probe_interval=10, probe_timeout=2,
+                 down_threshold=3, up_threshold=2):
+        self.global_init = global_init
+        self.probe_port = probe_port
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self.down_threshold = down_threshold
+        self.up_threshold = up_threshold
+        self.mtime = None
+        self.role = 'standalone'
+        self.peer = None
+        self.peer_up = True
+        self.probe_results = 0
+
+    def read_global_init(self):
+        """Update role and peer when global.init has changed."""
+        try:
+            mtime = os.stat(self.global_init).st_mtime
+        except OSError:
+            self.mtime = None
+            self.role = 'standalone'
+            return
+        if mtime == self.mtime:
+            return
+        global_init = read_json(self.global_init)
+        self.mtime = mtime
+
+        if global_init['init']['control']:
+            # Running on a router
+            fatal('This script is designed to run on a conductor. Exiting.')
+
+        conductors = global_init['init']['conductor']
+        if len(conductors) == 1:
+            # Running on non-HA conductor
+            self.role = 'standalone'
+            return
+
+        if len(conductors) != 2:
+            fatal('Something went wrong. '
+                  'Number of conductors in global.init should be 2! Exiting.')
+
+        ip_addresses = [c[1]['host'] for c in sorted(conductors.items())]
+        if is_local_address(ip_addresses[0]):
+            debug('we are the primary HA node')
+            self.role = 'primary'
+        elif is_local_address(ip_addresses[1]):
+            debug('we are the secondary HA node')
+            self.role = 'secondary'
+            self.peer = ip_addresses[0]
+        else:
+            fatal('Something went wrong. '
+                  'Conductor IPs do not match any local IP address. Exiting.')
+
+    def probe(self):
+        """Probe the primary node (on the secondary) with hysteresis."""
+        if self.role != 'secondary':
+            return
+        if probe_address(self.peer, self.probe_port, self.probe_timeout):
+            self.probe_results = max(self.probe_results, 0) + 1
+            if not self.peer_up and self.probe_results >= self.up_threshold:
+                debug('the primary HA node is up again')
+                self.peer_up = True
+        else:
+            self.probe_results = min(self.probe_results, 0) - 1
+            if self.peer_up and -self.probe_results >= self.down_threshold:
+                debug('the primary HA node is down - taking over')
+                self.peer_up = False
+
+    def run(self):
+        """Probe the peer periodically."""
+        while True:
+            time.sleep(self.probe_interval)
+            try:
+                self.read_global_init()
+                self.probe()
+            except Exception as e:
+                log('ERROR: HA leadership check failed: {}'.format(e))
+
+    def start(self):
+        """Determine the initial state and start the probe thread."""
+        self.read_global_init()
+        if self.role == 'secondary':
+            self.peer_up = probe_address(
+                self.peer, self.probe_port, self.probe_timeout)
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def is_active(self):
+        """Return true on the active node."""
+        if self.role == 'secondary':
+            return not self.peer_up
         return True
 
-    control = global_init['init']['control']
-    if control:
-        # Running on a router
-        fatal('This script is designed to run on a conductor. Exiting.')
 
-    host_ips = get_host_ips()
-    conductors = global_init['init']['conductor']
-    if len(conductors) == 1:
-        # Running on non-HA conductor
-        return True
+def get_leadership():
+    """Initialize and start HA leadership detection."""
+    leadership = HaLeadership(
+        probe_port=config.get('ha_probe_port', 443),
+        probe_interval=config.get('ha_probe_interval', 10),
+        probe_timeout=config.get('ha_probe_timeout', 2),
+        down_threshold=config.get('ha_down_threshold', 3),
+        up_threshold=config.get('ha_up_threshold', 2))
+    leadership.start()
+    return leadership
 
-    if len(conductors) != 2:
-        fatal('Something went wrong. '
-              'Number of conductors in global.init should be 2! Exiting.')
 
-    ip_addresses = [c[1]['host'] for c in sorted(conductors.items())]
-    host_ips = get_host_ips()
-    if ip_addresses[0] in host_ips:
-        debug('we are the primary HA node')
-        return True
-    if ip_addresses[1] in host_ips:
-        # we are the secondary HA node
-        try:
-            ping_node(ip_addresses[0])
-            debug('We are the secondary HA node and the primary is up.')
-            return False
-        except CalledProcessError:
-            debug('the primary HA node is down - taking over')
-            return True
-
-    fatal('Something went wrong. '
-          'Conductor IPs do not match any local IP address. Exiting.')
-    sys.exit(1)
+def node_is_active():
+    """Return true on active node."""
+    return leadership.is_active()
 
 
-def get_template():
+def get_template(key='template', default=None):
     """Initialize template."""
     try:
-        template_name = config['template']
+        template_name = config.get(key, default)
         template_path = template_name
         if not os.path.isabs(template_name):
             template_path = os.path.join(sys.path[0], template_name)
@@ -168,73 +464,495 @@ def create_email_body(mail_from, mail_recipients, alarm):
     )
 
 
+def create_digest_body(mail_from, mail_recipients, alarms):
+    """Create email body for a digest of several alarms."""
+    # distinct routers in order of appearance - jinja2 on conductors
+    # is too old for the unique filter
+    routers = list(OrderedDict.fromkeys(alarm['router'] for alarm in alarms))
+    return digest_template.render(
+        alarms=alarms,
+        routers=routers,
+        mail_from=mail_from,
+        mail_recipients=mail_recipients,
+    )
+
+
+class SmtpPool(object):
+    """Pool of smtp connections which are re-used across mails.
+
+    Connections that were idle for longer than idle_timeout are closed,
+    connections that were dropped by the server are re-established once.
+    """
+
+    def __init__(self, host='localhost', port='25', tls=False,
+                 user=None, password=None, size=1, idle_timeout=60):
+        self.host = host
+        self.port = port
+        self.tls = tls
+        self.user = user
+        self.password = password
+        self.idle_timeout = idle_timeout
+        self.idle = []
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(size)
+
+    def connect(self):
+        """Open a new smtp connection."""
+        if self.tls:
+            server = smtplib.SMTP_SSL(self.host, self.port)
+        else:
+            server = smtplib.SMTP(self.host, self.port)
+        if DEBUG:
+            server.set_debuglevel(1)
+        if self.user:
+            server.login(self.user, self.password)
+        return server
+
+    def disconnect(self, server):
+        """Close a connection - ignore errors of broken connections."""
+        try:
+            server.quit()
+        except (smtplib.SMTPException, socket.error):
+            server.close()
+
+    def acquire(self):
+        """Return an idle connection or open a new one."""
+        with self.lock:
+            while self.idle:
+                server, last_used = self.idle.pop()
+                if time.time() - last_used < self.idle_timeout:
+                    return server
+                self.disconnect(server)
+        return self.connect()
+
+    def release(self, server):
+        """Give a connection back to the pool."""
+        with self.lock:
+            self.idle.append((server, time.time()))
+
+    def close_idle(self):
+        """Close connections which exceeded the idle timeout."""
+        with self.lock:
+            now = time.time()
+            for server, last_used in self.idle:
+                if now - last_used >= self.idle_timeout:
+                    self.disconnect(server)
+            self.idle = [(server, last_used)
+                         for server, last_used in self.idle
+                         if now - last_used < self.idle_timeout]
+
+    def send(self, mail_from, mail_recipients, body):
+        """Send a mail - reconnect once if the connection was dropped."""
+        with self.slots:
+            server = self.acquire()
+            for attempt in range(2):
+                try:
+                    server.sendmail(mail_from, mail_recipients, body)
+                    break
+                except (smtplib.SMTPException, socket.error) as e:
+                    # on python 3 SMTPException is a subclass of
+                    # socket.error (OSError) - check replies first
+                    if isinstance(e, smtplib.SMTPException) and \
+                            not isinstance(e, smtplib.SMTPServerDisconnected):
+                        # the connection is still usable for the next mail
+                        self.release(server)
+                        raise
+                    server.close()
+                    if attempt:
+                        raise
+                    debug('SMTP connection was dropped. Reconnecting.')
+                    server = self.connect()
+            self.release(server)
+
+
+def get_smtp_pool():
+    """Initialize smtp connection pool."""
+    return SmtpPool(
+        host=config.get('mail_host', 'localhost'),
+        port=config.get('mail_port', '25'),
+        tls=config.get('mail_tls', False),
+        user=config.get('mail_user'),
+        password=config.get('mail_pass'),
+        size=config.get('mail_connections', config.get('mail_workers', 4)),
+        idle_timeout=config.get('mail_idle_timeout', 60),
+    )
+
+
 def send_mail(mail_from, mail_recipients, body):
     """Send a mail via smtp."""
-    mail_host = config.get('mail_host', 'localhost')
-    mail_port = config.get('mail_port', '25')
-    mail_tls = config.get('mail_tls', False)
-    mail_user = config.get('mail_user')
-    mail_pass = config.get('mail_pass')
-    if mail_tls:
-        server = smtplib.SMTP_SSL(mail_host, mail_port)
-    else:
-        server = smtplib.SMTP(mail_host, mail_port)
-    # TODO implement SMTP AUTH
-    if DEBUG:
-        server.set_debuglevel(1)
-    server.sendmail(mail_from, mail_recipients, body)
-    server.quit()
+    smtp_pool.send(mail_from, mail_recipients, body)
+
+
+class AlarmJournal(object):
+    """Journal of processed alarms in a sqlite database.
+
+    Alarms are appended and indexed by alarm id, router and timestamp.
+    The oldest alarms are removed once the journal exceeds max_rows or
+    max_age_days.
+    """
+
+    schema = '''
+        CREATE TABLE IF NOT EXISTS alarms (
+            seq INTEGER PRIMARY KEY,
+            id TEXT,
+            router TEXT,
+            ts INTEGER,
+            subtype TEXT,
+            alarm TEXT
+        );
+        CREATE INDEX IF NOT EXISTS alarms_id ON alarms (id);
+        CREATE INDEX IF NOT EXISTS alarms_router ON alarms (router, ts);
+        CREATE INDEX IF NOT EXISTS alarms_ts ON alarms (ts);
+    '''
+
+    def __init__(self, filename, max_rows=100000, max_age_days=30):
+        self.max_rows = max_rows
+        self.max_age_days = max_age_days
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        # allow to give pages of removed alarms back to the filesystem
+        self.db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        self.db.executescript(self.schema)
+
+    def append(self, alarms):
+        """Append alarms and remove the oldest ones beyond the limits."""
+        now = int(time.time())
+        rows = [(alarm.get('id'), alarm.get('router'), alarm.get('ts', now),
+                 alarm.get('subtype'), json.dumps(alarm)) for alarm in alarms]
+        with self.lock:
+            self.db.executemany(
+                'INSERT INTO alarms (id, router, ts, subtype, alarm) '
+                'VALUES (?, ?, ?, ?, ?)', rows)
+            if self.max_age_days:
+                self.db.execute('DELETE FROM alarms WHERE ts < ?',
+                                (now - self.max_age_days * 86400,))
+            if self.max_rows:
+                self.db.execute(
+                    'DELETE FROM alarms WHERE seq <= '
+                    '(SELECT MAX(seq) FROM alarms) - ?', (self.max_rows,))
+            self.db.commit()
+            # execute() steps the pragma once and frees a single page,
+            # executescript() runs it to completion
+            self.db.executescript('PRAGMA incremental_vacuum')
+
+    def query(self, alarm_id=None, router=None, since=None, until=None,
+              limit=100):
+        """Return the latest alarms matching all given conditions."""
+        conditions = []
+        parameters = []
+        for column, operator, value in (('id', '=', alarm_id),
+                                        ('router', '=', router),
+                                        ('ts', '>=', since),
+                                        ('ts', '<', until)):
+            if value is not None:
+                conditions.append('{} {} ?'.format(column, operator))
+                parameters.append(value)
+        query = 'SELECT alarm FROM alarms'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY seq DESC LIMIT ?'
+        parameters.append(limit)
+        with self.lock:
+            rows = self.db.execute(query, parameters).fetchall()
+        return [json.loads(row[0]) for row in reversed(rows)]
+
+
+def get_journal():
+    """Initialize alarm journal."""
+    journal_file = '/var/lib/128technology/t128-email-alarms-ha.db'
+    if TESTING:
+        # testing runs next to alarms-stream.txt
+        journal_file = 't128-email-alarms-ha.db'
+    return AlarmJournal(
+        config.get('journal_file', journal_file),
+        config.get('journal_max_rows', 100000),
+        config.get('journal_max_age_days', 30))
 
 
 def write_alarms(alarms):
-    """Write alarms to json file."""
-    processed_alarms = alarms
-    try:
-        with open('/tmp/processed_alarms.json', 'r') as fd:
-            processed_alarms = json.load(fd)
-            processed_alarms.extend(alarms)
-    except FileNotFoundError:
-        pass
-    with open('/tmp/processed_alarms.json', 'w') as fd:
-            json.dump(processed_alarms, fd)
+    """Write alarms to the journal."""
+    journal.append(alarms)
 
 
-def get_interface_description(router, node, interface):
-    """Retrieve interface description."""
+def parse_time(value):
+    """Convert a UTC date (and time) string or unix timestamp to int."""
+    if value is None or value.isdigit():
+        return value and int(value)
+    for fmt in ('%Y-%m-%d', '%Y-%m-%dT%H:%M', '%Y-%m-%d %H:%M'):
+        try:
+            return calendar.timegm(time.strptime(value, fmt))
+        except ValueError:
+            pass
+    fatal('Invalid time format: {}'.format(value))
+
+
+def query_journal(args):
+    """Print alarms from the journal as json lines."""
+    for alarm in journal.query(args.alarm_id, args.router,
+                               parse_time(args.since), parse_time(args.until),
+                               args.limit):
+        print(json.dumps(alarm))
+
+
+class LruTtlCache(object):
+    """Least recently used cache whose entries expire after ttl seconds."""
+
+    missing = object()
+
+    def __init__(self, size=1024, ttl=300):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Return cached value or LruTtlCache.missing."""
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[1] < time.time():
+                return self.missing
+            # re-insert as most recently used
+            self.entries[key] = entry
+            return entry[0]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, time.time() + self.ttl)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+def graphql_query(query):
+    """Run a graphql query against the conductor's api."""
     headers = {
         'Content-Type': 'application/json',
         'Authorization': 'Bearer {}'.format(config['api_key']),
     }
-    url = 'https://{}/api/v1/graphql'.format(config['api_host'])
-    query = '{ allRouters(name: "' + router + \
+    url = '{}://{}/api/v1/graphql'.format(
+        config.get('api_scheme', 'https'), config['api_host'])
+    with metrics.timer('graphql_request_seconds'):
+        return api_session.post(
+            url, headers=headers, verify=False, json={'query': query})
+
+
+def interface_description_query(router, node, interface, alias=''):
+    """Return the graphql selection for an interface description."""
+    if alias:
+        alias = alias + ': '
+    return alias + 'allRouters(name: "' + router + \
         '") { nodes { nodes(name: "' + node + '") { nodes { '\
         'deviceInterfaces(name: "' + interface + \
-        '") { nodes { description } } } } } } }'
-    request = requests.post(
-        url, headers=headers, verify=False, json={'query': query})
+        '") { nodes { description } } } } } }'
+
+
+def extract_description(data):
+    """Return description of an allRouters query result."""
+    return data['nodes'][0]['nodes']['nodes'][0]['deviceInterfaces']\
+        ['nodes'][0]['description']
+
+
+def get_interface_description(router, node, interface):
+    """Retrieve interface description."""
+    key = (router, node, interface)
+    description = description_cache.get(key)
+    if description is not LruTtlCache.missing:
+        return description
+
+    query = '{ ' + interface_description_query(router, node, interface) + ' }'
+    request = graphql_query(query)
     if request.status_code == 200:
         try:
-            description = request.json()['data']['allRouters']['nodes'][0]\
-                ['nodes']['nodes'][0]['deviceInterfaces']\
-                ['nodes'][0]['description']
-            return description
-        except KeyError:
-            return None
+            description = extract_description(
+                request.json()['data']['allRouters'])
+        except (KeyError, IndexError, TypeError):
+            description = None
+        description_cache.set(key, description)
+        return description
     else:
         raise Exception(
             "Query failed to run by returning code of {}. {}".format(
                 request.status_code, query))
 
 
+def prefetch_interface_descriptions(keys, batch_size=50):
+    """Fill the description cache with one aliased query per batch."""
+    keys = [key for key in OrderedDict.fromkeys(keys)
+            if description_cache.get(key) is LruTtlCache.missing]
+    for start in range(0, len(keys), batch_size):
+        batch = keys[start:start + batch_size]
+        selections = [interface_description_query(*key, alias='i{}'.format(i))
+                      for i, key in enumerate(batch)]
+        request = graphql_query('{ ' + ' '.join(selections) + ' }')
+        if request.status_code != 200:
+            debug('Prefetching interface descriptions failed:',
+                  request.status_code)
+            return
+        data = request.json().get('data') or {}
+        for i, key in enumerate(batch):
+            try:
+                description = extract_description(data['i{}'.format(i)])
+            except (KeyError, IndexError, TypeError):
+                description = None
+            description_cache.set(key, description)
+
+
+def get_device_name(message):
+    """Return the device name of an alarm message or None."""
+    key = 'DeviceName:'
+    if key not in message:
+        return None
+    device_field = [f for f in message.split('|') if key in f]
+    return device_field[0].replace(key, '').strip()
+
+
+class RuleEngine(object):
+    """Ignore and replace rules for alarm messages compiled once.
+
+    Rules are either plain strings (ignore_subjects) or [old, new] pairs
+    (replace_rules) as before, or dicts which may enable regular
+    expressions and restrict a rule to some routers:
+
+        {"pattern": "...", "regex": true, "routers": ["router1"]}
+        {"old": "...", "new": "...", "regex": true, "routers": ["router1"]}
+
+    All rules which apply to a router are combined into one regular
+    expression, so an alarm whose message matches no rule costs a single
+    search. Replace rules are applied one after another (in config order)
+    only if the combined expression matches.
+    """
+
+    def __init__(self, ignore_subjects, replace_rules):
+        self.ignore_rules = [
+            self.compile_rule(rule, 'pattern') for rule in ignore_subjects]
+        self.replace_rules = []
+        for rule in replace_rules:
+            if isinstance(rule, dict):
+                new = rule['new']
+            else:
+                rule, new = rule
+            self.replace_rules.append(self.compile_rule(rule, 'old') + (new,))
+        self.scoped_routers = set()
+        for rule in self.ignore_rules + self.replace_rules:
+            self.scoped_routers.update(rule[3] or [])
+        self.router_rules = {}
+
+    @staticmethod
+    def compile_rule(rule, key):
+        """Return (regex source, pattern, is regex, routers)."""
+        if not isinstance(rule, dict):
+            rule = {key: rule}
+        pattern = rule[key]
+        if rule.get('regex', False):
+            return (pattern, re.compile(pattern), True, rule.get('routers'))
+        return (re.escape(pattern), pattern, False, rule.get('routers'))
+
+    @staticmethod
+    def combine(rules):
+        """Return one compiled expression matching any of the rules."""
+        if not rules:
+            return None
+        try:
+            return re.compile('|'.join('(?:{})'.format(r[0]) for r in rules))
+        except re.error:
+            # e.g. backreferences in regex rules - search one by one
+            return AnyPattern([re.compile(r[0]) for r in rules])
+
+    def get_router_rules(self, router):
+        """Return compiled (ignore, replace, replace rules) of a router."""
+        if router not in self.scoped_routers:
+            # all routers without scoped rules share the global rules
+            router = None
+        if router not in self.router_rules:
+            def applies(rule):
+                return not rule[3] or router in rule[3]
+            replace_rules = [r for r in self.replace_rules if applies(r)]
+            self.router_rules[router] = (
+                self.combine([r for r in self.ignore_rules if applies(r)]),
+                self.combine(replace_rules),
+                replace_rules)
+        return self.router_rules[router]
+
+    def is_ignored(self, router, message):
+        ignore, _, _ = self.get_router_rules(router)
+        return bool(ignore and ignore.search(message))
+
+    def replace(self, router, message):
+        """Return the message with all replace rules applied."""
+        _, combined, replace_rules = self.get_router_rules(router)
+        if not combined or not combined.search(message):
+            return message
+        for _, pattern, is_regex, _, new in replace_rules:
+            if is_regex:
+                message = pattern.sub(new, message)
+            else:
+                message = message.replace(pattern, new)
+        return message
+
+
+class AnyPattern(object):
+    """List of compiled expressions searched one after another."""
+
+    def __init__(self, patterns):
+        self.patterns = patterns
+
+    def search(self, message):
+        for pattern in self.patterns:
+            match = pattern.search(message)
+            if match:
+                return match
+        return None
+
+
+def get_rule_engine():
+    """Return the rule engine - rebuild it when the config file changed."""
+    global rule_engine
+    now = time.time()
+    if rule_engine and now < rule_engine.checked + config.get(
+            'rules_reload_interval', 10):
+        return rule_engine
+    with rule_engine_lock:
+        if rule_engine:
+            rule_engine.checked = now
+        try:
+            mtime = os.stat(config_file).st_mtime
+        except (OSError, TypeError):
+            mtime = None
+        if rule_engine and rule_engine.mtime == mtime:
+            return rule_engine
+        rules_config = config
+        if rule_engine:
+            try:
+                rules_config = read_json(config_file)
+                info('Config file has changed. Reloading rules.')
+            except (IOError, ValueError) as e:
+                info('Could not reload rules: {}'.format(e))
+                rule_engine.mtime = mtime
+                return rule_engine
+        try:
+            engine = RuleEngine(rules_config.get('ignore_subjects', []),
+                                rules_config.get('replace_rules', []))
+        except (re.error, KeyError, TypeError, ValueError) as e:
+            if not rule_engine:
+                fatal('Invalid rules in config file: {}'.format(e))
+            info('Invalid rules in config file: {}'.format(e))
+            rule_engine.mtime = mtime
+            return rule_engine
+        engine.mtime = mtime
+        engine.checked = now
+        rule_engine = engine
+        return rule_engine
+
+
 def replace_messages(alarms):
     """Replace messages in alarms."""
+    engine = get_rule_engine()
     for alarm in alarms:
-        for old, new in config.get('replace_rules', []):
-            orig = alarm['message']
-            changed = orig.replace(old, new)
-            if orig != changed:
-                debug('Message replaced:', orig, '=>', changed)
-                alarm['message'] = changed
+        orig = alarm['message']
+        changed = engine.replace(alarm.get('router'), orig)
+        if orig != changed:
+            debug('Message replaced:', orig, '=>', changed)
+            alarm['message'] = changed
 
 
 def get_hash(alarm):
@@ -249,28 +967,50 @@ def get_hash(alarm):
         return alarm['id']
 
 
+def expire_seen_hashes(now):
+    """Remove hashes from the cache whose ttl is expired."""
+    while seen_hashes_cache:
+        key, expiry = next(iter(seen_hashes_cache.items()))
+        if expiry > now:
+            break
+        del seen_hashes_cache[key]
+
+
 def filter_duplicate_alarms(alarms):
-    """Filter alarms if already seen in interval."""
+    """Filter alarms if already seen in interval (or within ttl)."""
     global cleaned_duplicates
-    seen_hashes = []
-    seen_add_ids = []
+    expire_seen_hashes(time.time())
+    seen_hashes = set()
     distinct_alarms = []
     testing('all alarms:', len(alarms))
     for alarm in alarms:
-        subtype = alarm['subtype']
-        hash = get_hash(alarm)
-        if (hash, subtype) in seen_hashes:
-            debug('found duplicate:', hash, subtype)
+        key = (get_hash(alarm), alarm['subtype'])
+        if key in seen_hashes or key in seen_hashes_cache:
+            debug('found duplicate:', *key)
             cleaned_duplicates += 1
+            metrics.inc('deduplicated_total')
             continue
-        seen_hashes.append((hash, subtype))
+        seen_hashes.add(key)
         distinct_alarms.append(alarm)
     return distinct_alarms
 
 
+def remember_alarms(alarms):
+    """Remember hashes of mailed alarms for the next intervals (ttl)."""
+    ttl = config.get('duplicate_ttl', 0)
+    if not ttl:
+        return
+    expiry = time.time() + ttl
+    for alarm in alarms:
+        # re-insert to keep the cache ordered by expiry
+        key = (get_hash(alarm), alarm['subtype'])
+        seen_hashes_cache.pop(key, None)
+        seen_hashes_cache[key] = expiry
+
+
 def filter_cleared_alarms(alarms):
     """Filter alarms if already cleared in interval."""
-    seen_alarms = {}
+    seen_alarms = OrderedDict()
     for alarm in alarms:
         hash = get_hash(alarm)
         if alarm['subtype'] == 'ADD':
@@ -283,141 +1023,435 @@ def filter_cleared_alarms(alarms):
             else:
                 debug('We got a clear that does not match an existing alarm.')
                 seen_alarms[hash] = alarm
+    metrics.inc('cleared_total', len(alarms) - len(seen_alarms))
     testing('added + cleared alarms:', len(alarms),
             'after cleaning add/clear:', len(seen_alarms))
     return list(seen_alarms.values())
 
 
+def filter_alarms(alarms):
+    """Run alarms through the configured replace and filter rules."""
+    replace_messages(alarms)
+    if config.get('filter_duplicate_alarms', False):
+        alarms = filter_duplicate_alarms(alarms)
+    if config.get('not_send_cleared_alarms', False):
+        alarms = filter_cleared_alarms(alarms)
+    if config.get('filter_duplicate_alarms', False):
+        # only alarms which passed all filters are suppressed later on
+        remember_alarms(alarms)
+    return alarms
+
+
+def get_recipients(router):
+    """Return the list of mail recipients for a router."""
+    all_recipients = config['mail_recipients']
+    mail_recipients = all_recipients['default']
+    if router in all_recipients:
+        mail_recipients = all_recipients[router]
+    if type(mail_recipients) != list:
+        mail_recipients = [mail_recipients]
+    return mail_recipients
+
+
+def queue_mail(mail_from, mail_recipients, body, alarm_count=1):
+    """Hand over a mail to the sender worker of the recipients list.
+
+    Mails to the same recipients are always sent by the same worker, so
+    their order is kept while different recipients are sent in parallel.
+    """
+    worker = hash(tuple(mail_recipients)) % len(mail_queues)
+    mail_queues[worker].put((mail_from, mail_recipients, body, alarm_count))
+
+
+def deliver_mail(mail_from, mail_recipients, body, alarm_count=1):
+    """Send a mail and account for it - errors are logged."""
+    try:
+        with metrics.timer('smtp_send_seconds'):
+            send_mail(mail_from, mail_recipients, body)
+        metrics.inc('mails_total', result='sent')
+        metrics.inc('mailed_total', alarm_count)
+    except Exception as e:
+        metrics.inc('mails_total', result='failed')
+        metrics.inc('failed_total', alarm_count)
+        log('ERROR: Sending mail to {} failed: {}'.format(
+            ', '.join(mail_recipients), e))
+
+
+def send_mails_thread(mail_queue):
+    """Threaded mail sender."""
+    while True:
+        mail = mail_queue.get()
+        try:
+            deliver_mail(*mail)
+        finally:
+            mail_queue.task_done()
+
+
+def start_mail_workers(workers):
+    """Start sender threads - each one with its own queue."""
+    for _ in range(workers):
+        mail_queue = queue.Queue()
+        worker = threading.Thread(target=send_mails_thread, args=(mail_queue,))
+        worker.daemon = True
+        worker.start()
+        mail_queues.append(mail_queue)
+
+
 def handle_alarms(queue_lock):
     """Consume an alarm."""
     global alarms
 
-    if TESTING:
-        time.sleep(1)
+    # take over the queued alarms - the receiver continues with a new list
+    with queue_lock:
+        pending_alarms = alarms
+        alarms = []
+
+    if should_process(pending_alarms):
+        with metrics.timer('stage_seconds', stage='total'):
+            process_alarms(pending_alarms)
+
 
-    if not alarms:
+def should_process(pending_alarms):
+    """Return true if the alarms of an interval should be processed."""
+    if not pending_alarms:
         # nothing to do during this interval
-        return
+        return False
+
+    now = time.time()
+    for alarm in pending_alarms:
+        metrics.observe('queue_delay_seconds', now - alarm.get('ts', now))
 
     # only handling alarms if we are the active node
     if not node_is_active():
         debug('Node is not active. Sleeping until next interval.')
-        with queue_lock:
-            alarms = []
-        return
+        metrics.inc('ignored_total', len(pending_alarms), reason='inactive')
+        return False
+    return True
 
+
+def device_keys(alarms):
+    """Return (router, node, device) of all alarms related to a device."""
+    return [(alarm['router'], alarm['node'], get_device_name(alarm['message']))
+            for alarm in alarms if get_device_name(alarm['message'])]
+
+
+def process_alarms(pending_alarms):
+    """Filter alarms, render and queue their mails."""
     # send a mail to configured recipients dependent on the router
-    with queue_lock:
-        debug('{} alarms in the queue'.format(len(alarms)))
-        replace_messages(alarms)
-        if config.get('filter_duplicate_alarms', False):
-            alarms = filter_duplicate_alarms(alarms)
-        if config.get('not_send_cleared_alarms', False):
-            alarms = filter_cleared_alarms(alarms)
-        for alarm in alarms:
-            # lookup device interface
-            message = alarm['message']
-            router = alarm['router']
-            node = alarm['node']
-            key = 'DeviceName:'
-            if key in message:
-                try:
-                    device_field = [f for f in message.split('|') if key in f]
-                    device = device_field[0].replace(key, '').strip()
-                    description = get_interface_description(
-                        router, node, device)
-                    interface_string = device
-                    if description:
-                        interface_string = '{} ({})'.format(
-                            device, description)
-                    alarm['interface_description'] = interface_string
-                except IndexError:
-                    pass
-            # lookup recipients
-            mail_from = config['mail_from']
-            all_recipients = config['mail_recipients']
-            mail_recipients = all_recipients['default']
-            router = alarm['router']
-            if router in all_recipients:
-                mail_recipients = all_recipients[router]
-            if type(mail_recipients) != list:
-                mail_recipients = [mail_recipients]
-            mail_recipients_str = ', '.join(mail_recipients)
-            email_body = create_email_body(
-                mail_from, mail_recipients_str, alarm)
-            debug('alarm:', email_body, '\nrecipients:', mail_recipients_str)
-            if DRY_RUN:
-                # do not send mails
-                continue
-            info('Sending mail to {} for alarm id {}'.format(
-                mail_recipients_str, alarm['id']))
-            if not TESTING:
-                send_mail(mail_from, mail_recipients, email_body)
-        write_alarms(alarms)
-        testing('remaining alarms:', len(alarms))
-        alarms = []
-        testing('cleaned_duplicates:', cleaned_duplicates)
+    debug('{} alarms in the queue'.format(len(pending_alarms)))
+    with metrics.timer('stage_seconds', stage='filter'):
+        pending_alarms = filter_alarms(pending_alarms)
+    # lookup all device interfaces of this interval at once
+    with metrics.timer('stage_seconds', stage='lookup'):
+        prefetch_interface_descriptions(device_keys(pending_alarms))
+    with metrics.timer('stage_seconds', stage='render'):
+        mails = render_mails(pending_alarms)
+    if not TESTING:
+        for mail in mails:
+            queue_mail(*mail)
+    with metrics.timer('stage_seconds', stage='journal'):
+        write_alarms(pending_alarms)
+    testing('remaining alarms:', len(pending_alarms))
+    testing('cleaned_duplicates:', cleaned_duplicates)
+    if smtp_pool:
+        smtp_pool.close_idle()
+
+
+def render_mails(pending_alarms):
+    """Return (mail_from, recipients, body, alarm count) of all mails."""
+    mail_from = config['mail_from']
+    mails = []
+    digests = OrderedDict()
+    for alarm in pending_alarms:
+        # lookup device interface
+        device = get_device_name(alarm['message'])
+        if device:
+            description = get_interface_description(
+                alarm['router'], alarm['node'], device)
+            interface_string = device
+            if description:
+                interface_string = '{} ({})'.format(
+                    device, description)
+            alarm['interface_description'] = interface_string
+        mail_recipients = get_recipients(alarm['router'])
+        if digest_template:
+            # collect alarms per recipients list for a digest mail
+            digests.setdefault(tuple(mail_recipients), []).append(alarm)
+            continue
+        mail_recipients_str = ', '.join(mail_recipients)
+        email_body = create_email_body(
+            mail_from, mail_recipients_str, alarm)
+        debug('alarm:', email_body, '\nrecipients:', mail_recipients_str)
+        if DRY_RUN:
+            # do not send mails
+            continue
+        info('Sending mail to {} for alarm id {}'.format(
+            mail_recipients_str, alarm['id']))
+        mails.append((mail_from, mail_recipients, email_body, 1))
+    for mail_recipients, digest_alarms in digests.items():
+        mail_recipients_str = ', '.join(mail_recipients)
+        email_body = create_digest_body(
+            mail_from, mail_recipients_str, digest_alarms)
+        debug('digest:', email_body, '\nrecipients:', mail_recipients_str)
+        if DRY_RUN:
+            continue
+        info('Sending digest mail to {} for {} alarms'.format(
+            mail_recipients_str, len(digest_alarms)))
+        mails.append((mail_from, list(mail_recipients), email_body,
+                      len(digest_alarms)))
+    return mails
 
 
 def handle_alarms_thread(queue_lock):
     """Threaded alarm consumer."""
     while True:
-        handle_alarms(queue_lock)
-        time.sleep(mail_interval)
+        if mail_interval > 0:
+            time.sleep(mail_interval)
+        else:
+            # synchronous processing - wait for the receiver
+            alarms_event.wait()
+            alarms_event.clear()
+        try:
+            handle_alarms(queue_lock)
+        except Exception as e:
+            log('ERROR: Handling alarms failed: {}'.format(e))
+
+
+class EventStreamParser(object):
+    """Incremental parser for server-sent events.
+
+    Lines are fed one by one (without line endings). A complete event is
+    returned on the empty line that terminates it: a dict with the keys
+    'id', 'event' and 'data', where multiple data fields are joined by
+    newlines.
+    """
+
+    def __init__(self):
+        self.last_event_id = None
+        self.retry = None
+        self.reset()
+
+    def reset(self):
+        """Drop an incomplete event, e.g. after a reconnect."""
+        self.event_id = self.last_event_id
+        self.event_type = None
+        self.data = []
+
+    def feed(self, line):
+        """Parse a line - return an event once it is complete."""
+        if not line:
+            # dispatch event
+            if not self.data:
+                self.event_type = None
+                return None
+            self.last_event_id = self.event_id
+            event = {
+                'id': self.last_event_id,
+                'event': self.event_type or 'message',
+                'data': '\n'.join(self.data),
+            }
+            self.event_type = None
+            self.data = []
+            return event
+        if line.startswith(':'):
+            # comment, e.g. keep-alive
+            return None
+        field, _, value = line.partition(':')
+        if value.startswith(' '):
+            value = value[1:]
+        if field == 'data':
+            self.data.append(value)
+        elif field == 'event':
+            self.event_type = value
+        elif field == 'id':
+            self.event_id = value
+        elif field == 'retry' and value.isdigit():
+            self.retry = int(value) / 1000.0
+        return None
+
+
+def parse_event_stream(lines, parser=None):
+    """Yield all events of an iterable of lines."""
+    if not parser:
+        parser = EventStreamParser()
+    for line in lines:
+        if type(line) is bytes:
+            line = line.decode('utf-8')
+        event = parser.feed(line.rstrip('\r\n'))
+        if event:
+            yield event
+
+
+def describe_error(error):
+    """Describe a stream error by its type and HTTP status only.
+
+    The messages of requests errors contain the url, which holds the
+    api token.
+    """
+    status = getattr(error, 'status_code', None)
+    response = getattr(error, 'response', None)
+    if response is not None:
+        status = response.status_code
+    if status:
+        return '{}: HTTP {}'.format(type(error).__name__, status)
+    return type(error).__name__
+
+
+class EventStreamClient(object):
+    """Client for the conductor's event stream which never gives up.
+
+    Connection errors are retried with exponential backoff and jitter.
+    After a reconnect the stream is resumed by sending the id of the last
+    received event as Last-Event-ID header (if the server provides ids).
+    A stream without any data (not even keep-alives) for read_timeout
+    seconds is considered stalled and reconnected.
+    """
+
+    def __init__(self, url, session, backoff_initial=1, backoff_max=60,
+                 read_timeout=90):
+        self.url = url
+        self.session = session
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+        self.read_timeout = read_timeout
+        self.parser = EventStreamParser()
+        self.counters = {
+            'connects': 0,
+            'reconnects': 0,
+            'events': 0,
+            'parse_errors': 0,
+        }
+
+    def connect(self):
+        """Open the event stream - resume at the last event if possible."""
+        headers = {'Accept': 'text/event-stream'}
+        if self.parser.last_event_id:
+            headers['Last-Event-ID'] = self.parser.last_event_id
+        response = self.session.get(self.url, headers=headers, stream=True,
+                                    verify=False,
+                                    timeout=(10, self.read_timeout))
+        response.raise_for_status()
+        self.counters['connects'] += 1
+        return response
+
+    def events(self):
+        """Yield events forever - reconnect on errors."""
+        backoff = self.backoff_initial
+        while True:
+            try:
+                response = self.connect()
+                self.parser.reset()
+                for event in parse_event_stream(response.iter_lines(),
+                                                self.parser):
+                    backoff = self.backoff_initial
+                    self.counters['events'] += 1
+                    yield event
+                error = 'stream closed'
+            except Exception as e:
+                error = describe_error(e)
+            self.counters['reconnects'] += 1
+            delay = self.parser.retry or backoff
+            delay = random.uniform(delay / 2.0, delay)
+            info('Event stream interrupted ({}). Reconnecting in {:.1f} '
+                 'seconds. reconnects={reconnects} parse_errors='
+                 '{parse_errors}'.format(error, delay, **self.counters))
+            time.sleep(delay)
+            backoff = min(backoff * 2, self.backoff_max)
+
+
+def parse_alarm(data):
+    """Return the alarm of an event's data or None if not relevant."""
+    event = json.loads(data)
+    if event['type'] != 'alarm':
+        # unsupported
+        return None
+
+    alarm = event['alarm']
+    alarm['subtype'] = event['subtype']
+    metrics.inc('received_total')
+
+    if get_rule_engine().is_ignored(alarm.get('router'), alarm['message']):
+        metrics.inc('ignored_total', reason='rule')
+        debug('ignore alarm:', alarm['message'])
+        return None
+    return alarm
+
+
+def accept_alarm(event, counters):
+    """Return the alarm of an event if it should be queued."""
+    try:
+        alarm = parse_alarm(event['data'])
+    except (ValueError, KeyError, TypeError) as e:
+        counters['parse_errors'] += 1
+        debug('Could not parse event:', event['data'], e)
+        return None
+    if not alarm:
+        return None
+    # alarms without shelved status are not shelved
+    if alarm.get('shelvedStatus', 'NOTSHELVED') != 'NOTSHELVED':
+        metrics.inc('ignored_total', reason='shelved')
+        return None
+    alarm['ts'] = int(time.time())
+    return alarm
 
 
 def receive_alarms(queue_lock):
     """Connect to stream API and receive alarms."""
-    global alarms
-    url = 'https://{}/api/v1/events?token={}'.format(
-        config['api_host'], config['api_key'])
-    i = 0
-    while True:
-        if TESTING and i > 0:
-            break
-        i = 1
+    url = '{}://{}/api/v1/events?token={}'.format(
+        config.get('api_scheme', 'https'), config['api_host'],
+        config['api_key'])
+    client = EventStreamClient(
+        url, requests.Session(),
+        config.get('reconnect_backoff_initial', 1),
+        config.get('reconnect_backoff_max', 60),
+        config.get('stream_read_timeout', 90))
+    for name in ('connects', 'reconnects', 'parse_errors'):
+        metrics.gauge('event_stream_{}'.format(name),
+                      'Event stream {}'.format(name.replace('_', ' ')),
+                      lambda name=name: client.counters[name])
+    if TESTING:
+        events = parse_event_stream(open('alarms-stream.txt'))
+    else:
+        events = client.events()
+    for event in events:
         try:
-            if TESTING:
-                iterator = open('alarms-stream.txt').readlines()
-            else:
-                r = requests.get(url, stream=True, verify=False)
-                iterator = r.iter_lines()
-            for line in iterator:
-                if type(line) is bytes:
-                    line = line.decode('utf-8')
-                if not line.startswith('data: '):
-                    continue
-
-                event = json.loads(line.strip('data: '))
-                if event['type'] != 'alarm':
-                    # unsupported
-                    continue
-
-                alarm = event['alarm']
-                alarm['subtype'] = event['subtype']
-
-                subject_match = False
-                for subject in config.get('ignore_subjects', []):
-                    if subject in alarm['message']:
-                        subject_match = True
-                if subject_match:
-                    debug('ignore alarm:', alarm['message'])
-                    continue
-
-                if alarm['shelvedStatus'] == 'NOTSHELVED':
-                    with queue_lock:
-                        # queue an alarm
-                        debug('receiver: {} alarms in the queue'.format(
-                            len(alarms)))
-                        alarm['ts'] = int(time.time())
-                        alarms.append(alarm)
-                    if mail_interval == 0:
-                        # synchronous processing
-                        debug('mail_interval is 0, process immediately')
-                        handle_alarms(queue_lock)
-        except:
-            # catch all exceptions for now and re-conncect
+            alarm = accept_alarm(event, client.counters)
+        except Exception as e:
+            # a single bad event must not stop the receiver
+            client.counters['parse_errors'] += 1
+            info('Could not handle event: {} ({})'.format(event, e))
+            continue
+        if not alarm:
             continue
+        with queue_lock:
+            # queue an alarm
+            debug('receiver: {} alarms in the queue'.format(len(alarms)))
+            alarms.append(alarm)
+        if mail_interval == 0:
+            # synchronous processing by the consumer thread
+            debug('mail_interval is 0, process immediately')
+            alarms_event.set()
+
+
+def run_benchmark(rounds):
+    """Replay alarms-stream.txt through the filters and report alarms/sec."""
+    with open('alarms-stream.txt') as fd:
+        lines = fd.readlines()
+    total = 0
+    start = time.time()
+    for _ in range(rounds):
+        # each round is treated as one interval
+        alarms = []
+        for event in parse_event_stream(lines):
+            alarm = parse_alarm(event['data'])
+            if alarm and alarm.get('shelvedStatus', 'NOTSHELVED') == \
+                    'NOTSHELVED':
+                alarms.append(alarm)
+        total += len(alarms)
+        filter_alarms(alarms)
+    duration = time.time() - start
+    info('Processed {} alarms in {:.3f} seconds: {:.0f} alarms/sec'.format(
+        total, duration, total / duration if duration else 0))
 
 
 def main():
@@ -425,36 +1459,82 @@ def main():
     global TESTING
     global DRY_RUN
     global config
+    global config_file
     global mail_interval
     global template
+    global digest_template
+    global smtp_pool
+    global api_session
+    global description_cache
+    global journal
+    global leadership
+    global metrics
     args = parse_arguments()
     DEBUG = args.debug
     TESTING = args.testing
     DRY_RUN = args.dry_run
-    config = read_json(args.config_file)
+    config_file = args.config_file
+    config = read_json(config_file)
+    check_config(config)
+    if args.query:
+        journal = get_journal()
+        query_journal(args)
+        return
+
     mail_interval = config.get('mail_interval', 60)
     template = get_template()
+    if config.get('mail_digest', False):
+        digest_template = get_template(
+            'digest_template', 't128-email-alarms-ha-digest.template')
+    smtp_pool = get_smtp_pool()
+    api_session = requests.Session()
+    description_cache = LruTtlCache(
+        config.get('description_cache_size', 1024),
+        config.get('description_cache_ttl', 300))
+    metrics = Metrics()
+    get_rule_engine()
+
+    if args.benchmark:
+        run_benchmark(args.benchmark)
+        return
+
+    journal = get_journal()
+    leadership = get_leadership()
+    register_gauges()
+    if config.get('metrics_port'):
+        start_metrics_server(
+            config.get('metrics_address', '127.0.0.1'),
+            config['metrics_port'])
+
+    if args.engine == 'asyncio':
+        try:
+            import t128_email_alarms_asyncio
+        except (ImportError, SyntaxError) as e:
+            fatal('The asyncio engine is not available: {}'.format(e))
+        t128_email_alarms_asyncio.run(sys.modules[__name__])
+        return
 
     # setup threads
+    start_mail_workers(config.get('mail_workers', 4))
     queue_lock = threading.Lock()
-    threads = []
     receiver = threading.Thread(target=receive_alarms, args=(queue_lock,))
     receiver.start()
-    threads.append(receiver)
 
-    if mail_interval > 0:
-        if TESTING:
-            consumer = threading.Thread(
-                target=handle_alarms, args=(queue_lock,))
-        else:
-            consumer = threading.Thread(
-                target=handle_alarms_thread, args=(queue_lock,))
+    if TESTING:
+        # process the replayed stream at once
+        start = time.time()
+        receiver.join()
+        handle_alarms(queue_lock)
+        testing('processed in {:.3f} seconds'.format(time.time() - start))
+    else:
+        consumer = threading.Thread(
+            target=handle_alarms_thread, args=(queue_lock,))
         consumer.start()
-        threads.append(consumer)
-
-    # wait for threads to finish
-    for thread in threads:
-        thread.join()
+        # wait for threads to finish
+        receiver.join()
+        consumer.join()
+    for mail_queue in mail_queues:
+        mail_queue.join()
 
 
 if __name__ == '__main__':
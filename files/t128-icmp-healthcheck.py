@@ -1,22 +1,52 @@
 #!/usr/bin/env python
 
 from __future__ import print_function
+import argparse
+import errno
 import json
+import mmap
 import os
+import re
+import select
 import smtplib
-from subprocess import call, check_call, CalledProcessError
+import socket
+import struct
+from subprocess import call, check_call, CalledProcessError, Popen, PIPE
 import sys
-from time import ctime, strftime, time
+import threading
+from email.mime.text import MIMEText
+from time import ctime, sleep, strftime, time
+
+try:
+    import queue  # py3k
+except ImportError:
+    import Queue as queue
 
 
 TIMEOUT = 30
 TEST_HOST = '1.1.1.1'
 MAIL_ENABLED = False
+MAIL_SERVER = 'localhost'
+MAIL_FROM = 'root'
+MAIL_TO = 'root'
+# state file of previous versions - only read for migration
 STATE_FILE = '/run/128technology/icmp-healthcheck.json'
+STATUS_FILE = '/run/128technology/icmp-healthcheck.status'
 RESTART_CMD = '/usr/bin/systemctl restart 128T'
 REBOOT_CMD = '/usr/sbin/reboot'
 GLOBAL_INIT = '/etc/128technology/global.init'
-PING_COMMAND = 'ping -q -c 4 -W 8'
+PING_COMMAND = 'ping -q -n -c 4 -W 8'
+PROBE_TIMEOUT = 8
+PROBE_COUNT = 4
+PROBE_INTERVAL = 1
+DAEMON_INTERVAL = 10
+MAX_INTERVAL = 60
+# share of failed checks in the TIMEOUT window to restart 128T and
+# in the REBOOT_GRACE window after the restart to reboot
+RESTART_LOSS = 1.0
+REBOOT_LOSS = 1.0
+# minimum time between 128T restart and reboot
+REBOOT_GRACE = 5 * 60
 
 basename = os.path.basename(__file__).replace('.py', '')
 
@@ -34,26 +64,304 @@ except ModuleNotFoundError:
         """Log to stderr on systemd-free systems."""
         print(*messages, file=sys.stderr)
 
+# Query systemd via D-Bus when available - fork systemctl otherwise
 try:
-    from subprocess import DEVNULL  # py3k
+    import dbus
 except ImportError:
-    import os
-    DEVNULL = open(os.devnull, 'wb')
+    dbus = None
+system_bus = None
+
+
+# Layout of the status file (keep in sync with _grains/icmp_healthcheck.py):
+# header, one bucket (minute, checks, failures) per minute of the window
+# and a slot per destination with counters and a ring of rtts in us.
+STATUS_MAGIC = b'T128ICMP'
+STATUS_VERSION = 1
+STATES = ('unknown', 'success', 'timeout')
+MAX_DESTINATIONS = 8
+RING_SIZE = 32
+WINDOW_MINUTES = 60
+LOST = 0xffffffff
+HEADER = struct.Struct('<8sHHHHIB3xIIIII')
+BUCKET = struct.Struct('<IHH')
+DESTINATION = struct.Struct('<64sIIIIHH{}I'.format(RING_SIZE))
+SEQ_OFFSET = 16
+
+
+class DestinationStats(object):
+    """Probe counters and a ring buffer of the last rtts of a destination."""
+
+    def __init__(self, name, sent=0, received=0, last_success=0,
+                 last_rtt=LOST, position=0, count=0, ring=None):
+        self.name = name
+        self.sent = sent
+        self.received = received
+        self.last_success = last_success
+        self.last_rtt = last_rtt
+        self.position = position
+        self.count = count
+        self.ring = list(ring or [LOST] * RING_SIZE)
+
+    def add(self, rtt, now):
+        """Add a probe result - rtt is None for lost probes."""
+        self.sent += 1
+        value = LOST
+        if rtt is not None:
+            self.received += 1
+            self.last_success = now
+            value = min(int(rtt * 1000000), LOST - 1)
+            self.last_rtt = value
+        self.ring[self.position] = value
+        self.position = (self.position + 1) % RING_SIZE
+        self.count = min(self.count + 1, RING_SIZE)
+
+    def samples(self):
+        """Return the rtts in the ring, oldest first."""
+        start = (self.position - self.count) % RING_SIZE
+        return [self.ring[(start + i) % RING_SIZE] for i in range(self.count)]
+
+    def loss(self):
+        samples = self.samples()
+        if not samples:
+            return 0.0
+        return float(samples.count(LOST)) / len(samples)
+
+    def to_dict(self):
+        rtts = [rtt / 1000.0 for rtt in self.samples() if rtt != LOST]
+        return {
+            'sent': self.sent,
+            'received': self.received,
+            'last_success': self.last_success,
+            'loss': round(self.loss(), 3),
+            'rtt_last_ms': rtts[-1] if rtts else None,
+            'rtt_avg_ms': round(sum(rtts) / len(rtts), 3) if rtts else None,
+            'rtt_max_ms': max(rtts) if rtts else None,
+        }
+
+
+def read_consistent(fd, retries=10):
+    """Copy the status file while no update is in progress (seqlock)."""
+    for _ in range(retries):
+        fd.seek(SEQ_OFFSET)
+        seq = fd.read(4)
+        fd.seek(0)
+        data = fd.read()
+        fd.seek(SEQ_OFFSET)
+        if len(seq) == 4 and struct.unpack('<I', seq)[0] % 2 == 0 and \
+                fd.read(4) == seq:
+            return data
+        sleep(0.01)
+    return None
+
+
+class StatusFile(object):
+    """Healthcheck state and statistics in a fixed-layout status file.
+
+    The file is memory-mapped and updated in place. The sequence number
+    in the header is odd while an update is in progress, so readers can
+    retry instead of seeing a partial update.
+    """
+
+    size = HEADER.size + BUCKET.size * WINDOW_MINUTES + \
+        DESTINATION.size * MAX_DESTINATIONS
+
+    def __init__(self, file_name=STATUS_FILE, read_only=False):
+        self.map = None
+        self.seq = 0
+        self.state = 'unknown'
+        self.started = 0
+        self.last_success = 0
+        self.restarted = 0
+        self.interval = 0
+        self.updated = 0
+        self.buckets = [[0, 0, 0] for _ in range(WINDOW_MINUTES)]
+        self.destinations = {}
+        if read_only:
+            # copy the file without ever writing to it
+            with open(file_name, 'rb', 0) as fd:
+                data = read_consistent(fd)
+            if data is None:
+                raise IOError('Status file is being updated: {}'.format(
+                    file_name))
+        else:
+            fd = os.open(file_name, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                if os.fstat(fd).st_size != self.size:
+                    os.ftruncate(fd, 0)
+                    os.ftruncate(fd, self.size)
+                self.map = mmap.mmap(fd, self.size)
+            finally:
+                os.close(fd)
+            data = self.map
+        if len(data) == self.size and \
+                data[:len(STATUS_MAGIC)] == STATUS_MAGIC and \
+                HEADER.unpack_from(data)[1] == STATUS_VERSION:
+            self.load(data)
+        elif not read_only:
+            self.migrate()
+
+    def load(self, data):
+        """Read the status written by a previous run."""
+        (_, _, _, _, _, self.seq, state, self.started, self.last_success,
+         self.restarted, self.interval, self.updated) = \
+            HEADER.unpack_from(data)
+        self.state = STATES[state] if state < len(STATES) else 'unknown'
+        offset = HEADER.size
+        for bucket in self.buckets:
+            bucket[:] = BUCKET.unpack_from(data, offset)
+            offset += BUCKET.size
+        for _ in range(MAX_DESTINATIONS):
+            values = DESTINATION.unpack_from(data, offset)
+            offset += DESTINATION.size
+            name = values[0].rstrip(b'\0').decode('utf-8')
+            if name:
+                self.destinations[name] = DestinationStats(
+                    name, *values[1:7], ring=values[7:])
+
+    def migrate(self):
+        """Take over state and last success of the json state file."""
+        try:
+            with open(STATE_FILE) as fd:
+                state = json.load(fd)
+            self.state = state.get('state', 'unknown')
+            self.last_success = state.get('last_success', 0)
+            self.started = self.last_success
+        except (IOError, OSError, ValueError):
+            pass
 
+    def record_check(self, success, now):
+        """Count a check in the bucket of the current minute."""
+        minute = now // 60
+        bucket = self.buckets[minute % WINDOW_MINUTES]
+        if bucket[0] != minute:
+            bucket[:] = [minute, 0, 0]
+        bucket[1] += 1
+        if not success:
+            bucket[2] += 1
+        if not self.started:
+            self.started = now
 
-def read_state(file_name=STATE_FILE):
-    """Read previous state from file."""
+    def loss(self, now, seconds):
+        """Return the share of failed checks during the last seconds."""
+        minute = now // 60
+        minutes = min(WINDOW_MINUTES, max(1, seconds // 60))
+        checks = failures = 0
+        for bucket_minute, bucket_checks, bucket_failures in self.buckets:
+            if minute - minutes < bucket_minute <= minute:
+                checks += bucket_checks
+                failures += bucket_failures
+        if not checks:
+            return 0.0
+        return float(failures) / checks
+
+    def destination(self, name):
+        """Return the stats of a destination - None if all slots are used."""
+        if name not in self.destinations:
+            if len(self.destinations) >= MAX_DESTINATIONS:
+                return None
+            self.destinations[name] = DestinationStats(name)
+        return self.destinations[name]
+
+    def remove_destinations(self, names):
+        """Free the slots of destinations which are no longer probed."""
+        for name in list(self.destinations):
+            if name not in names:
+                del self.destinations[name]
+
+    def write(self, now):
+        """Update the file in place."""
+        self.updated = now
+        # odd while writing - even if a killed writer left it odd
+        self.seq = (self.seq + 1) | 1
+        struct.pack_into('<I', self.map, SEQ_OFFSET, self.seq)
+        HEADER.pack_into(
+            self.map, 0, STATUS_MAGIC, STATUS_VERSION, MAX_DESTINATIONS,
+            RING_SIZE, WINDOW_MINUTES, self.seq, STATES.index(self.state),
+            self.started, self.last_success, self.restarted,
+            self.interval, self.updated)
+        offset = HEADER.size
+        for bucket in self.buckets:
+            BUCKET.pack_into(self.map, offset, *bucket)
+            offset += BUCKET.size
+        slots = sorted(self.destinations.values(), key=lambda d: d.name)
+        for i in range(MAX_DESTINATIONS):
+            if i < len(slots):
+                d = slots[i]
+                values = [d.name.encode('utf-8')[:64], d.sent, d.received,
+                          d.last_success, d.last_rtt, d.position,
+                          d.count] + d.ring
+            else:
+                values = [b'', 0, 0, 0, LOST, 0, 0] + [LOST] * RING_SIZE
+            DESTINATION.pack_into(self.map, offset, *values)
+            offset += DESTINATION.size
+        self.seq += 1
+        struct.pack_into('<I', self.map, SEQ_OFFSET, self.seq)
+
+    def to_dict(self):
+        now = int(time())
+        return {
+            'state': self.state,
+            'last_success': self.last_success,
+            'restarted': self.restarted,
+            'interval': self.interval,
+            'updated': self.updated,
+            'loss': round(self.loss(now, TIMEOUT * 60), 3),
+            'destinations': dict(
+                (name, stats.to_dict())
+                for name, stats in self.destinations.items()),
+        }
+
+    def close(self):
+        if self.map:
+            self.map.close()
+
+
+def parse_arguments():
+    """Get commandline arguments."""
+    parser = argparse.ArgumentParser(
+        description='Restart 128T/reboot when no destination is reachable.')
+    parser.add_argument('--daemon', action='store_true',
+                        help='keep running and check every interval')
+    parser.add_argument('--interval', type=int, default=DAEMON_INTERVAL,
+                        help='seconds between checks in daemon mode '
+                        '(used while checks fail)')
+    parser.add_argument('--max-interval', type=int, default=MAX_INTERVAL,
+                        help='seconds between checks on healthy links')
+    parser.add_argument('--restart-loss', type=float, default=RESTART_LOSS,
+                        help='share of failed checks within {} minutes to '
+                        'restart 128T'.format(TIMEOUT))
+    parser.add_argument('--reboot-loss', type=float, default=REBOOT_LOSS,
+                        help='share of failed checks after the restart to '
+                        'reboot')
+    parser.add_argument('--status-file', default=STATUS_FILE,
+                        help='status file')
+    parser.add_argument('--status', action='store_true',
+                        help='print the status file as json and exit')
+    return parser.parse_args()
+
+
+def send_mail(subject, body):
+    """Send a notification mail if enabled."""
+    if not MAIL_ENABLED:
+        return
+    message = MIMEText(body)
+    message['Subject'] = subject
+    message['From'] = MAIL_FROM
+    message['To'] = MAIL_TO
     try:
-        with open(file_name) as fd:
-            return json.load(fd)
-    except:
-        return {'state': 'unknown'}
+        server = smtplib.SMTP(MAIL_SERVER)
+        server.sendmail(MAIL_FROM, [MAIL_TO], message.as_string())
+        server.quit()
+    except (smtplib.SMTPException, socket.error) as e:
+        log_journal('Could not send mail:', e)
 
 
-def write_state(state, file_name=STATE_FILE):
-    """Write current state to file."""
-    with open(file_name, 'w') as fd:
-        json.dump(state, fd)
+def get_mtime(file_name):
+    """Return mtime of a file or None if it does not exist."""
+    try:
+        return os.stat(file_name).st_mtime
+    except OSError:
+        return None
 
 
 def get_global_init():
@@ -91,73 +399,307 @@ def get_node_name(config):
     return node_name
 
 
-def safety_net_is_enabled():
-    """Return if safety_net service is running."""
+def checksum(data):
+    """Calculate the internet checksum of a packet."""
+    if len(data) % 2:
+        data += b'\0'
+    total = sum(struct.unpack('!{}H'.format(len(data) // 2), data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+def open_icmp_socket():
+    """Return an icmp socket and whether it is a raw socket.
+
+    Raw sockets need root, datagram icmp sockets are allowed for the
+    groups in net.ipv4.ping_group_range.
+    """
     try:
-        check_call(['systemctl', 'is-active', '--quiet', 'safety_net'])
+        return socket.socket(
+            socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP), True
+    except socket.error as e:
+        if e.errno not in (errno.EPERM, errno.EACCES):
+            raise
+    return socket.socket(
+        socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP), False
+
+
+def icmp_probe(destination, timeout=PROBE_TIMEOUT, count=PROBE_COUNT):
+    """Send echo requests until one is answered - return rtt or None."""
+    address = socket.gethostbyname(destination)
+    sock, raw = open_icmp_socket()
+    ident = (os.getpid() ^ threading.current_thread().ident) & 0xffff
+    sent = {}
+    deadline = time() + timeout
+    next_send = 0
+    try:
+        while True:
+            now = time()
+            if now >= deadline:
+                return None
+            if len(sent) < count and now >= next_send:
+                seq = len(sent) + 1
+                header = struct.pack('!BBHHH', 8, 0, 0, ident, seq)
+                payload = struct.pack('!d', now)
+                packet = struct.pack('!BBHHH', 8, 0,
+                                     checksum(header + payload), ident, seq)
+                sock.sendto(packet + payload, (address, 0))
+                sent[seq] = now
+                next_send = now + PROBE_INTERVAL
+            wake_up = min(deadline, now + 0.5)
+            if len(sent) < count:
+                wake_up = min(wake_up, next_send)
+            ready, _, _ = select.select([sock], [], [], max(wake_up - now, 0))
+            if not ready:
+                continue
+            data, source = sock.recvfrom(2048)
+            data = bytearray(data)
+            if raw:
+                # strip the ip header
+                data = data[(data[0] & 0x0f) * 4:]
+            if source[0] != address or len(data) < 8:
+                continue
+            icmp_type, _, _, reply_ident, reply_seq = struct.unpack(
+                '!BBHHH', bytes(data[:8]))
+            # the kernel sets the id of datagram icmp sockets itself
+            if icmp_type != 0 or reply_seq not in sent or \
+                    (raw and reply_ident != ident):
+                continue
+            return time() - sent[reply_seq]
+    finally:
+        sock.close()
+    return None
+
+
+def ping_probe(destination, timeout=PROBE_TIMEOUT):
+    """Fork ping - return the average rtt or None."""
+    start = time()
+    process = Popen(PING_COMMAND.split(' ') + [destination],
+                    stdout=PIPE, stderr=PIPE)
+    while process.poll() is None:
+        if time() - start > timeout + PROBE_COUNT:
+            process.kill()
+            process.wait()
+            return None
+        sleep(0.1)
+    output = process.stdout.read().decode('utf-8', 'replace')
+    if process.returncode != 0:
+        return None
+    match = re.search(r'= [\d.]+/([\d.]+)/', output)
+    if match:
+        return float(match.group(1)) / 1000
+    return time() - start
+
+
+def probe(destination, timeout=PROBE_TIMEOUT):
+    """Probe a destination in-process - fall back to forking ping."""
+    try:
+        return icmp_probe(destination, timeout)
+    except (socket.error, OSError) as e:
+        # e.g. no icmp sockets available or not an ipv4 destination
+        log_journal('ICMP probe to', destination, 'not possible:', e,
+                    '- using ping.')
+        return ping_probe(destination, timeout)
+
+
+def probe_destinations(destinations, timeout=PROBE_TIMEOUT, results=None):
+    """Probe all destinations concurrently.
+
+    Returns (destination, rtt) of the first successful probe or
+    (None, None) if all probes failed. All probes are run to completion
+    (bounded by the probe timeout), so the statistics of every destination
+    are complete. If a results dict is given, the rtt (or None) of each
+    probe is stored there.
+    """
+    finished = queue.Queue()
+
+    def run(destination):
+        try:
+            rtt = probe(destination, timeout)
+        except Exception as e:
+            log_journal('Probe to', destination, 'failed:', e)
+            rtt = None
+        finished.put((destination, rtt))
+
+    for destination in destinations:
+        thread = threading.Thread(target=run, args=(destination,))
+        thread.daemon = True
+        thread.start()
+    first = (None, None)
+    for _ in destinations:
+        destination, rtt = finished.get()
+        if results is not None:
+            results[destination] = rtt
+        if rtt is not None and first[0] is None:
+            first = (destination, rtt)
+    return first
+
+
+def dbus_unit_is_active(unit):
+    """Return if a systemd unit is active - queried via D-Bus."""
+    global system_bus
+    if not system_bus:
+        system_bus = dbus.SystemBus()
+    systemd = system_bus.get_object(
+        'org.freedesktop.systemd1', '/org/freedesktop/systemd1')
+    manager = dbus.Interface(systemd, 'org.freedesktop.systemd1.Manager')
+    unit_path = manager.LoadUnit(unit)
+    properties = dbus.Interface(
+        system_bus.get_object('org.freedesktop.systemd1', unit_path),
+        'org.freedesktop.DBus.Properties')
+    return properties.Get(
+        'org.freedesktop.systemd1.Unit', 'ActiveState') == 'active'
+
+
+def unit_is_active(unit):
+    """Return if a systemd unit is active."""
+    if dbus:
+        try:
+            return dbus_unit_is_active(unit)
+        except dbus.DBusException as e:
+            log_journal('Could not query systemd via D-Bus:', e)
+    try:
+        check_call(['systemctl', 'is-active', '--quiet', unit])
         return True
     except CalledProcessError:
         return False
 
 
-def main():
-    """Run Main loop."""
-    config = get_global_init()
+def safety_net_is_enabled():
+    """Return if safety_net service is running."""
+    return unit_is_active('safety_net.service')
+
+
+def check(config, status, now, restart_loss=RESTART_LOSS,
+          reboot_loss=REBOOT_LOSS):
+    """Run one health check and update the status.
+
+    Returns the loss of the successful destination - 1.0 if all failed.
+    """
     node_name = get_node_name(config)
     destinations = get_destinations(config)
-    state = read_state()
-
-    # Round seconds to current minute
-    this_minute = int(time() / 60) * 60
+    status.remove_destinations(destinations)
 
     # When safety net is enabled: consider current time as successful
     # to avoid immediate reboot after safety_net stop (e.g. 128T upgrades)
     if safety_net_is_enabled():
-        state['last_success'] = this_minute
+        status.last_success = now
+        status.record_check(True, now)
         log_journal('Safety_net is running. Do not perform checks.')
-        write_state(state)
-        return
+        return 0.0
 
-    # When any destination can be pinged,
-    # write success to state file and break the loop.
-    for destination in destinations:
-        try:
-            check_call(
-                PING_COMMAND.split(' ') + [destination],
-                stdout=DEVNULL)
-            state['state'] = 'success'
-            state['last_success'] = this_minute
-            log_journal('Ping to', destination, 'was successful.')
-            write_state(state)
-            return
-        except CalledProcessError:
-            pass
+    results = {}
+    destination, rtt = probe_destinations(destinations, results=results)
+    for name, result in results.items():
+        stats = status.destination(name)
+        if stats:
+            stats.add(result, now)
+    status.record_check(bool(destination), now)
+
+    # When any destination can be pinged, remember the success. Stay in
+    # timeout while the checks since the 128T restart are too lossy.
+    if destination:
+        status.last_success = now
+        if status.state == 'timeout':
+            loss = status.loss(now, now - status.restarted)
+            if loss >= reboot_loss:
+                return loss
+        if status.state != 'success':
+            log_journal('Ping to', destination, 'was successful',
+                        '({:.1f} ms).'.format(rtt * 1000))
+        status.state = 'success'
+        stats = status.destination(destination)
+        return stats.loss() if stats else 0.0
 
-    # When none can be pinged and state timeout is in state file
-    # -> reboot machine
-    if state['state'] == 'timeout':
+    # Without any successful check there is no working link to restore.
+    # The status file is on tmpfs - after a reboot the restart timer
+    # starts with the first success, so a dead WAN does not reboot the
+    # router again and again.
+    if not status.last_success:
+        return 1.0
+
+    # When the checks after the 128T restart are still too lossy
+    # -> reboot machine (after 128T had some time to come up)
+    if status.state == 'timeout':
+        if now - status.restarted < REBOOT_GRACE or \
+                status.loss(now, REBOOT_GRACE) < reboot_loss:
+            return 1.0
         log_journal('Pinging was unsuccessful and 128T restart did not help.',
                     'Reboot machine.')
-        send_mail('{}: Restart 128T on node {}'.format(basename, node_name),
+        send_mail('{}: Reboot node {}'.format(basename, node_name),
                   'Last successful ping on: {} {}'.format(
-                      ctime(state['last_success']), strftime("%z")))
+                      ctime(status.last_success), strftime("%z")))
         call(REBOOT_CMD.split(' '))
+        return 1.0
+
+    # When too many checks failed over the last <timeout> minutes
+    # -> set timeout state and restart 128T
+    window = TIMEOUT * 60
+    if now - status.started > window and now - status.restarted > window \
+            and status.loss(now, window) >= restart_loss:
+        status.state = 'timeout'
+        status.restarted = now
+        log_journal('Pinging was unsuccessful over the last', TIMEOUT,
+                    'minutes.', 'Restarting 128T service.')
+        send_mail('{}: Restart 128T on node {}'.format(basename, node_name),
+                  'Last successful ping on: {} {}'.format(
+                      ctime(status.last_success), strftime("%z")))
+        call(RESTART_CMD.split(' '))
+    return 1.0
+
+
+def run_daemon(args):
+    """Check in adaptive intervals - keep the status in memory.
+
+    global.init is re-read when it changes. Healthy links are checked
+    less often (up to max_interval), as soon as probes get lost the
+    interval drops back to the minimum.
+    """
+    status = StatusFile(args.status_file)
+    config = None
+    config_mtime = None
+    interval = args.interval
+    log_journal('Started in daemon mode. Checking every', args.interval,
+                'to', args.max_interval, 'seconds.')
+    while True:
+        start = time()
+        mtime = get_mtime(GLOBAL_INIT)
+        if config is None or mtime != config_mtime:
+            config = get_global_init()
+            config_mtime = mtime
+            log_journal('Destinations:', ', '.join(get_destinations(config)))
+        loss = check(config, status, int(start),
+                     args.restart_loss, args.reboot_loss)
+        if loss:
+            interval = args.interval
+        else:
+            interval = min(interval * 2, args.max_interval)
+        status.interval = interval
+        status.write(int(time()))
+        sleep(max(0, interval - (time() - start)))
+
+
+def main():
+    """Run a single check or the daemon loop."""
+    args = parse_arguments()
+    if args.status:
+        try:
+            status = StatusFile(args.status_file, read_only=True)
+        except (IOError, OSError) as e:
+            sys.exit('Could not read status file: {}'.format(e))
+        print(json.dumps(status.to_dict(), indent=2, sort_keys=True))
+        status.close()
+        return
+    if args.daemon:
+        run_daemon(args)
         return
 
-    # When none can be pinged and <timeout> minutes have been passed
-    # -> write timeout to state file, restart 128T, and break the loop
-    try:
-        if this_minute - state['last_success'] > (TIMEOUT * 60):
-            state['state'] = 'timeout'
-            log_journal('Pinging was unsuccessful over the last', TIMEOUT,
-                        'minutes.', 'Restarting 128T service.')
-            send_mail('{}: Reboot node {}'.format(basename, node_name),
-                      'Last successful ping on: {} {}'.format(
-                            ctime(state['last_success']), strftime("%z")))
-            call(RESTART_CMD.split(' '))
-            write_state(state)
-    except KeyError:
-        log_journal('Could not find "last_success" in state file.')
+    config = get_global_init()
+    status = StatusFile(args.status_file)
+    check(config, status, int(time()), args.restart_loss, args.reboot_loss)
+    status.write(int(time()))
+    status.close()
 
 
 if __name__ == '__main__':
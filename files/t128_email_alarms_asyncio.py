@@ -0,0 +1,314 @@
+"""asyncio engine for t128-email-alarms-ha.py (python 3 only).
+
+The event stream is read by a coroutine on the event loop. GraphQL
+lookups and smtp sends still use the blocking clients of the mailer
+(requests session and smtp pool), but they run in an executor and their
+concurrency is bounded by semaphores owned by the event loop. All state
+of the pipeline lives in the engine instead of module globals.
+"""
+
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import random
+import ssl
+import time
+
+
+class StreamStatusError(IOError):
+    """The event stream responded with an unexpected HTTP status."""
+
+    def __init__(self, status_code):
+        super().__init__('Unexpected response: HTTP {}'.format(status_code))
+        self.status_code = status_code
+
+
+class AsyncEventStream(object):
+    """Read the conductor's event stream with asyncio streams.
+
+    Behaves like EventStreamClient of the mailer: reconnects with
+    exponential backoff and jitter, resumes via Last-Event-ID and
+    reconnects a stream without data for read_timeout seconds.
+    """
+
+    def __init__(self, mailer):
+        self.mailer = mailer
+        config = mailer.config
+        self.host, _, port = config['api_host'].partition(':')
+        self.scheme = config.get('api_scheme', 'https')
+        self.port = int(port or (443 if self.scheme == 'https' else 80))
+        self.path = '/api/v1/events?token={}'.format(config['api_key'])
+        self.backoff_initial = config.get('reconnect_backoff_initial', 1)
+        self.backoff_max = config.get('reconnect_backoff_max', 60)
+        self.read_timeout = config.get('stream_read_timeout', 90)
+        self.parser = mailer.EventStreamParser()
+        self.counters = {
+            'connects': 0,
+            'reconnects': 0,
+            'events': 0,
+            'parse_errors': 0,
+        }
+
+    async def connect(self):
+        """Send the request - return reader, writer and chunked flag."""
+        ssl_context = None
+        if self.scheme == 'https':
+            ssl_context = ssl.create_default_context()
+            ssl_context.check_hostname = False
+            ssl_context.verify_mode = ssl.CERT_NONE
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(
+            self.host, self.port, ssl=ssl_context, limit=2 ** 20), 10)
+        headers = [
+            'GET {} HTTP/1.1'.format(self.path),
+            'Host: {}'.format(self.host),
+            'Accept: text/event-stream',
+            'Connection: close',
+        ]
+        if self.parser.last_event_id:
+            headers.append('Last-Event-ID: {}'.format(
+                self.parser.last_event_id))
+        writer.write(('\r\n'.join(headers) + '\r\n\r\n').encode('utf-8'))
+        await writer.drain()
+
+        status = (await reader.readline()).decode('latin-1').split()
+        if len(status) < 2 or status[1] != '200':
+            writer.close()
+            raise StreamStatusError(status[1] if len(status) > 1 else None)
+        chunked = False
+        while True:
+            line = (await reader.readline()).decode('latin-1').strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            if name.lower() == 'transfer-encoding' and 'chunked' in value:
+                chunked = True
+        self.counters['connects'] += 1
+        return reader, writer, chunked
+
+    async def read_lines(self, reader, chunked):
+        """Yield the lines of the response body."""
+        def read(coroutine):
+            # a stalled stream raises asyncio.TimeoutError
+            return asyncio.wait_for(coroutine, self.read_timeout)
+
+        if not chunked:
+            while True:
+                line = await read(reader.readline())
+                if not line:
+                    return
+                yield line
+        buffer = b''
+        while True:
+            size = int((await read(reader.readline())).split(b';')[0], 16)
+            if size == 0:
+                return
+            buffer += (await read(reader.readexactly(size + 2)))[:-2]
+            lines = buffer.split(b'\n')
+            buffer = lines.pop()
+            for line in lines:
+                yield line
+
+    async def events(self):
+        """Yield events forever - reconnect on errors."""
+        backoff = self.backoff_initial
+        while True:
+            writer = None
+            try:
+                reader, writer, chunked = await self.connect()
+                self.parser.reset()
+                async for line in self.read_lines(reader, chunked):
+                    event = self.parser.feed(
+                        line.decode('utf-8').rstrip('\r\n'))
+                    if event:
+                        backoff = self.backoff_initial
+                        self.counters['events'] += 1
+                        yield event
+                error = 'stream closed'
+            except (OSError, ValueError, asyncio.TimeoutError,
+                    asyncio.IncompleteReadError) as e:
+                error = self.mailer.describe_error(e)
+            finally:
+                if writer:
+                    writer.close()
+            self.counters['reconnects'] += 1
+            delay = self.parser.retry or backoff
+            delay = random.uniform(delay / 2.0, delay)
+            self.mailer.info(
+                'Event stream interrupted ({}). Reconnecting in {:.1f} '
+                'seconds. reconnects={reconnects} parse_errors='
+                '{parse_errors}'.format(error, delay, **self.counters))
+            await asyncio.sleep(delay)
+            backoff = min(backoff * 2, self.backoff_max)
+
+
+class AsyncEngine(object):
+    """Receive, filter and mail alarms coordinated by an event loop."""
+
+    def __init__(self, mailer):
+        self.mailer = mailer
+        self.metrics = mailer.metrics
+        self.alarms = []
+        self.alarms_event = asyncio.Event()
+        self.mail_queues = {}
+        self.senders = []
+        config = mailer.config
+        self.graphql_slots = asyncio.Semaphore(
+            config.get('graphql_concurrency', 4))
+        mail_connections = config.get(
+            'mail_connections', config.get('mail_workers', 4))
+        self.smtp_slots = asyncio.Semaphore(mail_connections)
+        self.executor = ThreadPoolExecutor(
+            mail_connections + config.get('graphql_concurrency', 4) + 2)
+        self.stream = AsyncEventStream(mailer)
+        for name in ('connects', 'reconnects', 'parse_errors'):
+            self.metrics.gauge(
+                'event_stream_{}'.format(name),
+                'Event stream {}'.format(name.replace('_', ' ')),
+                lambda name=name: self.stream.counters[name])
+        self.metrics.gauge('pending_alarms',
+                           'Alarms waiting for the next interval',
+                           lambda: len(self.alarms))
+        self.metrics.gauge('mail_queue_depth', 'Mails waiting to be sent',
+                           lambda: sum(q.qsize()
+                                       for q in self.mail_queues.values()))
+
+    async def blocking(self, func, *args):
+        """Run a blocking function in the executor."""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    async def replay_events(self):
+        """Yield the events of the recorded stream (testing mode)."""
+        with open('alarms-stream.txt') as fd:
+            for i, event in enumerate(self.mailer.parse_event_stream(fd)):
+                if i % 1000 == 0:
+                    # let other tasks run
+                    await asyncio.sleep(0)
+                yield event
+
+    async def receive(self):
+        """Queue the alarms of the event stream."""
+        if self.mailer.TESTING:
+            events = self.replay_events()
+        else:
+            events = self.stream.events()
+        async for event in events:
+            try:
+                alarm = self.mailer.accept_alarm(event, self.stream.counters)
+            except Exception as e:
+                # a single bad event must not stop the receiver
+                self.stream.counters['parse_errors'] += 1
+                self.mailer.info('Could not handle event: {} ({})'.format(
+                    event, e))
+                continue
+            if not alarm:
+                continue
+            self.alarms.append(alarm)
+            if self.mailer.mail_interval == 0:
+                self.alarms_event.set()
+
+    async def consume(self):
+        """Process the queued alarms each interval."""
+        while True:
+            if self.mailer.mail_interval > 0:
+                await asyncio.sleep(self.mailer.mail_interval)
+            else:
+                await self.alarms_event.wait()
+                self.alarms_event.clear()
+            try:
+                await self.handle()
+            except Exception as e:
+                self.mailer.log('ERROR: Handling alarms failed: {}'.format(e))
+
+    async def handle(self):
+        """Process the alarms queued since the last interval."""
+        pending_alarms, self.alarms = self.alarms, []
+        if not self.mailer.should_process(pending_alarms):
+            return
+        with self.metrics.timer('stage_seconds', stage='total'):
+            await self.process(pending_alarms)
+
+    async def prefetch(self, keys):
+        """Lookup interface descriptions with concurrent batches."""
+        async def prefetch_batch(batch):
+            async with self.graphql_slots:
+                await self.blocking(
+                    self.mailer.prefetch_interface_descriptions, batch)
+        # the batches share the mailer's requests session - query every
+        # missing interface only once
+        cache = self.mailer.description_cache
+        keys = [key for key in OrderedDict.fromkeys(keys)
+                if cache.get(key) is cache.missing]
+        batch_size = 50
+        await asyncio.gather(*[
+            prefetch_batch(keys[start:start + batch_size])
+            for start in range(0, len(keys), batch_size)])
+
+    async def process(self, pending_alarms):
+        """Filter alarms, render and queue their mails."""
+        mailer = self.mailer
+        with self.metrics.timer('stage_seconds', stage='filter'):
+            pending_alarms = mailer.filter_alarms(pending_alarms)
+        with self.metrics.timer('stage_seconds', stage='lookup'):
+            await self.prefetch(mailer.device_keys(pending_alarms))
+        with self.metrics.timer('stage_seconds', stage='render'):
+            # descriptions missed by the prefetch are looked up blocking
+            mails = await self.blocking(mailer.render_mails, pending_alarms)
+        if not mailer.TESTING:
+            for mail in mails:
+                self.queue_mail(*mail)
+        with self.metrics.timer('stage_seconds', stage='journal'):
+            await self.blocking(mailer.write_alarms, pending_alarms)
+        mailer.testing('remaining alarms:', len(pending_alarms))
+        mailer.testing('cleaned_duplicates:', mailer.cleaned_duplicates)
+        if mailer.smtp_pool:
+            await self.blocking(mailer.smtp_pool.close_idle)
+
+    def queue_mail(self, mail_from, mail_recipients, body, alarm_count=1):
+        """Queue a mail - one sender task per recipients list."""
+        key = tuple(mail_recipients)
+        if key not in self.mail_queues:
+            self.mail_queues[key] = asyncio.Queue()
+            self.senders.append(asyncio.ensure_future(
+                self.send_mails(self.mail_queues[key])))
+        self.mail_queues[key].put_nowait(
+            (mail_from, mail_recipients, body, alarm_count))
+
+    async def send_mails(self, mail_queue):
+        """Send the mails of a recipients list in order."""
+        while True:
+            mail = await mail_queue.get()
+            try:
+                async with self.smtp_slots:
+                    await self.blocking(self.mailer.deliver_mail, *mail)
+            finally:
+                mail_queue.task_done()
+
+    async def run(self):
+        if self.mailer.TESTING:
+            start = time.time()
+            await self.receive()
+            await self.handle()
+            self.mailer.testing('processed in {:.3f} seconds'.format(
+                time.time() - start))
+            return
+        await asyncio.gather(self.receive(), self.consume())
+
+
+def run(mailer):
+    """Run the asyncio engine for the mailer module until it is stopped."""
+    loop = asyncio.new_event_loop()
+    # the engine's events and semaphores are bound to the current loop
+    asyncio.set_event_loop(loop)
+    engine = AsyncEngine(mailer)
+    try:
+        loop.run_until_complete(engine.run())
+        for mail_queue in engine.mail_queues.values():
+            loop.run_until_complete(mail_queue.join())
+        for sender in engine.senders:
+            sender.cancel()
+        loop.run_until_complete(asyncio.gather(
+            *engine.senders, return_exceptions=True))
+    finally:
+        engine.executor.shutdown()
+        loop.close()
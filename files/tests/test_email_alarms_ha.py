@@ -0,0 +1,62 @@
+import importlib.util
+import os
+import unittest
+
+FILES_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+try:
+    spec = importlib.util.spec_from_file_location(
+        't128_email_alarms_ha',
+        os.path.join(FILES_DIR, 't128-email-alarms-ha.py'))
+    mailer = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mailer)
+except ImportError as e:
+    raise unittest.SkipTest('mailer dependencies missing: {}'.format(e))
+
+
+def alarm(subtype, alarm_id='1'):
+    return {
+        'id': alarm_id,
+        'subtype': subtype,
+        'category': 'INTERFACE',
+        'message': 'Intf wan1 (1) operationally down',
+        'process': 'highway',
+        'router': 'router1',
+        'severity': 'MAJOR',
+    }
+
+
+class FilterAlarmsTests(unittest.TestCase):
+
+    def setUp(self):
+        mailer.config = {
+            'filter_duplicate_alarms': True,
+            'not_send_cleared_alarms': True,
+            'duplicate_ttl': 3600,
+        }
+        mailer.metrics = mailer.Metrics()
+        mailer.rule_engine = None
+        mailer.seen_hashes_cache.clear()
+
+    def test_duplicates_within_ttl(self):
+        self.assertEqual(len(mailer.filter_alarms([alarm('ADD')])), 1)
+        self.assertEqual(mailer.filter_alarms([alarm('ADD', '2')]), [])
+
+    def test_add_clear_then_add(self):
+        # added and cleared in one interval - nothing is mailed
+        self.assertEqual(
+            mailer.filter_alarms([alarm('ADD'), alarm('CLEAR')]), [])
+        # so the alarm raised again in the next interval must be mailed
+        self.assertEqual(
+            [a['subtype'] for a in mailer.filter_alarms([alarm('ADD', '2')])],
+            ['ADD'])
+
+    def test_clear_after_mailed_add(self):
+        mailer.filter_alarms([alarm('ADD')])
+        self.assertEqual(
+            [a['subtype'] for a in mailer.filter_alarms([alarm('CLEAR')])],
+            ['CLEAR'])
+
+
+if __name__ == '__main__':
+    unittest.main()